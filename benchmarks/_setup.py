@@ -0,0 +1,17 @@
+# Shared by the benchmark scripts: import godstring without touching the
+# real database or settings.json of the checkout.
+import os
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_tmp = tempfile.mkdtemp(prefix="godstring-bench-")
+os.environ.setdefault("GODSTRING_DB", os.path.join(_tmp, "bench.db"))
+os.environ.setdefault("OPUS_CACHE_DIR", "")
+os.chdir(_tmp)
+sys.path.insert(0, REPO)
+
+import godstring  # noqa: E402
+
+__all__ = ["godstring", "REPO"]
@@ -0,0 +1,37 @@
+# Messages per second through classify_input, per input kind.
+#   python benchmarks/bench_classifier.py [iterations]
+import sys
+import time
+
+from _setup import godstring
+
+MESSAGES = {
+    "text": "drake god's plan",
+    "long text": "the weeknd blinding lights extended remix live at the super bowl",
+    "youtube": "https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42",
+    "youtu.be": "https://youtu.be/dQw4w9WgXcQ",
+    "other url": "https://soundcloud.com/artist/some-track",
+    "spotify playlist": "https://open.spotify.com/playlist/37i9dQZF1DXcBWIGoYBM5M?si=abc",
+    "mixed links": (
+        "https://youtu.be/dQw4w9WgXcQ https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC "
+        "https://open.spotify.com/album/1DFixLWuPkv3KT3TnV35m3"
+    ),
+}
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    classify = godstring.classify_input
+
+    print(f"{'input':<18} {'kind':<8} {'msg/s':>12}")
+    for name, raw in MESSAGES.items():
+        kind = classify(raw)[0]
+        start = time.perf_counter()
+        for _ in range(n):
+            classify(raw)
+        rate = n / (time.perf_counter() - start)
+        print(f"{name:<18} {kind:<8} {rate:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
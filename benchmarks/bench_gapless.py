@@ -0,0 +1,113 @@
+# Gap between the last packet of track N and the first packet of track N+1:
+# the old stop → after() → new ffmpeg path vs GaplessSource, with and without
+# crossfade. Fake sources stand in for ffmpeg: packets only become readable
+# `startup` seconds after the source is created (process spawn + first fill).
+#
+#   python benchmarks/bench_gapless.py [startup_ms]
+import array
+import sys
+import threading
+import time
+
+from _setup import godstring
+
+FRAME = 0.02          # discord reads one 20 ms packet at a time
+TRACK_SECONDS = 1.0
+
+
+class FakeSource:
+    def __init__(self, tag, seconds, startup, pcm=False):
+        self.tag = tag
+        self.frames = int(seconds / FRAME)
+        self.ready_at = time.perf_counter() + startup
+        self.pcm = pcm
+        self.sent = 0
+
+    def read(self):
+        wait = self.ready_at - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)   # the pipe is still empty
+        if self.sent >= self.frames:
+            return b""
+        self.sent += 1
+        if self.pcm:
+            level = 1000 if self.tag == "A" else 3000
+            return array.array("h", [level] * (godstring.PCM_FRAME_SIZE // 2)).tobytes()
+        return f"{self.tag}{self.sent}".encode()
+
+    def is_opus(self):
+        return not self.pcm
+
+    def cleanup(self):
+        pass
+
+
+def play(source, stop_after=None):
+    # a tiny AudioPlayer: read at the 20 ms cadence, note when packets came out
+    log = []
+    start = time.perf_counter()
+    n = 0
+    while True:
+        packet = source.read()
+        if not packet:
+            break
+        log.append((time.perf_counter(), packet))
+        n += 1
+        if stop_after and n >= stop_after:
+            break
+        delay = start + n * FRAME - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    return log
+
+
+def old_path(startup):
+    # track A ends, after() hops to the loop, the next vc.play spawns ffmpeg
+    a = play(FakeSource("A", TRACK_SECONDS, startup))
+    hop = threading.Event()
+    threading.Timer(0.001, hop.set).start()
+    hop.wait()
+    b = play(FakeSource("B", TRACK_SECONDS, startup))
+    return b[0][0] - a[-1][0] - FRAME, 0
+
+
+def gapless_path(startup, crossfade):
+    godstring.GAPLESS_CROSSFADE = crossfade
+    pcm = crossfade > 0
+    switched = []
+
+    source = godstring.GaplessSource(
+        FakeSource("A", TRACK_SECONDS, startup, pcm), TRACK_SECONDS,
+        lambda: switched.append(time.perf_counter()),
+    )
+
+    # the player arms GAPLESS_LEAD (8 s) before the end; these test tracks
+    # are shorter than that, so arm right after the start
+    def arm():
+        time.sleep(FRAME)
+        source.arm(FakeSource("B", TRACK_SECONDS, startup, pcm), TRACK_SECONDS, lambda: True)
+    threading.Thread(target=arm).start()
+
+    log = play(source)
+    times = [t for t, _ in log]
+    worst = max(b - a for a, b in zip(times, times[1:])) - FRAME
+    expected = int(2 * TRACK_SECONDS / FRAME) - int(crossfade / FRAME)
+    return worst, len(log) - expected
+
+
+def main():
+    startup = (float(sys.argv[1]) if len(sys.argv) > 1 else 400) / 1000
+
+    print(f"decoder startup {startup * 1000:.0f} ms, tracks {TRACK_SECONDS:.1f} s\n")
+    print(f"{'path':<22} {'gap ms':>8} {'missing frames':>15}")
+    for name, run in (
+        ("stop + new ffmpeg", lambda: old_path(startup)),
+        ("gapless", lambda: gapless_path(startup, 0)),
+        ("gapless, 0.2 s fade", lambda: gapless_path(startup, 0.2)),
+    ):
+        gap, missing = run()
+        print(f"{name:<22} {max(gap, 0) * 1000:>8.1f} {missing:>15}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# Memory held by discord.py's cache for a synthetic guild set, minimal vs
+# all intents. Each guild arrives as the GUILD_CREATE payload Discord would
+# send for that mode (plus the member chunks for "all"), and tracemalloc
+# measures what the ConnectionState keeps.
+#
+#   python benchmarks/bench_intents.py [scale]
+import gc
+import itertools
+import random
+import sys
+import tracemalloc
+
+import discord
+from discord.state import ConnectionState
+
+from _setup import godstring
+
+# (guild count, members per guild) at scale 1
+GUILD_SIZES = [(2, 20000), (8, 2000), (40, 200)]
+ONLINE = 0.3      # share of members with a presence
+IN_VOICE = 0.01   # share of members in a voice channel
+
+ids = itertools.count(10 ** 17)
+
+
+def user(uid):
+    return {
+        "id": str(uid), "username": f"user{uid % 100000}", "discriminator": "0",
+        "global_name": f"User {uid % 100000}", "avatar": None,
+    }
+
+
+def member(uid):
+    return {
+        "user": user(uid), "roles": [], "nick": None, "joined_at": "2024-01-01T00:00:00+00:00",
+        "deaf": False, "mute": False, "flags": 0,
+    }
+
+
+def presence(uid):
+    return {
+        "user": {"id": str(uid)}, "status": "online",
+        "client_status": {"desktop": "online"},
+        "activities": [{"name": "Spotify", "type": 2, "details": "some song", "state": "some artist"}],
+    }
+
+
+def guild_payload(size, mode, rng):
+    gid = next(ids)
+    text_id, voice_id = next(ids), next(ids)
+    uids = [next(ids) for _ in range(size)]
+    voice = [u for u in uids if rng.random() < IN_VOICE]
+
+    data = {
+        "id": str(gid), "name": f"guild {gid}", "owner_id": str(uids[0]),
+        "member_count": size, "large": size > 250, "features": [],
+        "emojis": [], "stickers": [], "premium_tier": 0,
+        "roles": [{
+            "id": str(gid), "name": "@everyone", "permissions": "0", "position": 0,
+            "color": 0, "hoist": False, "managed": False, "mentionable": False,
+        }],
+        "channels": [
+            {"id": str(text_id), "type": 0, "name": "music", "position": 0, "permission_overwrites": []},
+            {"id": str(voice_id), "type": 2, "name": "voice", "position": 1, "permission_overwrites": [],
+             "bitrate": 64000, "user_limit": 0},
+        ],
+        "voice_states": [{
+            "user_id": str(u), "channel_id": str(voice_id), "session_id": "x",
+            "deaf": False, "mute": False, "self_deaf": False, "self_mute": False,
+            "self_video": False, "suppress": False, "request_to_speak_timestamp": None,
+        } for u in voice],
+    }
+
+    if mode == "all":
+        # with GUILD_MEMBERS + chunking every member ends up in the payload
+        data["members"] = [member(u) for u in uids]
+        data["presences"] = [presence(u) for u in uids if rng.random() < ONLINE]
+    else:
+        # without it Discord only sends the members sitting in voice
+        data["members"] = [member(u) for u in voice]
+        data["presences"] = []
+    return data
+
+
+def measure(mode, scale):
+    intents, options = godstring.build_intents(mode)
+    rng = random.Random(1)
+    payloads = [
+        guild_payload(max(1, int(size * scale)), mode, rng)
+        for count, size in GUILD_SIZES for _ in range(count)
+    ]
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    state = ConnectionState(
+        dispatch=lambda *a, **k: None, handlers={}, hooks={}, http=None,
+        intents=intents, **options
+    )
+    for data in payloads:
+        state._add_guild_from_data(data)
+
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    used = sum(s.size_diff for s in after.compare_to(before, "filename"))
+    members = sum(len(g.members) for g in state.guilds)
+    del payloads
+    return used, members, len(state.guilds)
+
+
+def main():
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    print(f"discord.py {discord.__version__}, scale {scale}\n")
+    print(f"{'mode':<8} {'guilds':>7} {'cached members':>15} {'MB':>9}")
+
+    results = {}
+    for mode in ("all", "minimal"):
+        used, members, guilds = measure(mode, scale)
+        results[mode] = used
+        print(f"{mode:<8} {guilds:>7} {members:>15,} {used / 1024 / 1024:>9.1f}")
+
+    print(f"\nminimal keeps {results['minimal'] / results['all']:.1%} of the memory of all")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# Old full "ytsearch5" extraction vs the two-phase flat search + one full
+# extract, on recorded yt-dlp results.
+#
+#   python benchmarks/bench_search.py record "query one" "query two" ...
+#       runs yt-dlp for real (network) and saves the info dicts and timings
+#   python benchmarks/bench_search.py [fixtures.json]
+#       replays them through _extract_worker and prints the comparison
+import copy
+import json
+import os
+import pickle
+import sys
+import time
+
+from _setup import REPO, godstring
+
+FIXTURES = os.path.join(REPO, "benchmarks", "fixtures", "search.json")
+REPLAYS = 200
+
+
+def timed_extract(opts, url):
+    ytdl = godstring.YoutubeDL(opts)
+    start = time.perf_counter()
+    info = ytdl.sanitize_info(ytdl.extract_info(url, download=False))
+    return {"info": info, "seconds": time.perf_counter() - start}
+
+
+def record(queries, path):
+    fixtures = []
+    for q in queries:
+        print(f"recording {q!r}")
+        full = timed_extract(godstring.YTDL_OPTS, f"ytsearch5:{q}")
+        flat = timed_extract(godstring.YTDL_FLAT_OPTS, f"ytsearch5:{q}")
+        first = next(e for e in flat["info"]["entries"] if e)
+        pick = timed_extract(
+            godstring.YTDL_OPTS, f"https://www.youtube.com/watch?v={first['id']}"
+        )
+        fixtures.append({"query": q, "full": full, "flat": flat, "pick": pick})
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(fixtures, f)
+    print(f"saved {len(fixtures)} queries to {path}")
+
+
+class Replay:
+    # stands in for the worker's YoutubeDL, returns a recorded info dict
+    def __init__(self, info):
+        self.info = info
+
+    def extract_info(self, url, download=False):
+        return self.info
+
+
+def replay_worker(info, flat):
+    # local cost of one job: slimming plus pickling the result back
+    godstring._worker_ytdl[flat] = Replay(info)
+    start = time.perf_counter()
+    for _ in range(REPLAYS):
+        payload = pickle.dumps(godstring._extract_worker("replay", flat))
+    return (time.perf_counter() - start) / REPLAYS, len(payload)
+
+
+def replay(path):
+    if not os.path.exists(path):
+        sys.exit(
+            f"no fixtures at {path}\n"
+            f"run `python benchmarks/bench_search.py record \"query\" ...` first"
+        )
+    with open(path) as f:
+        fixtures = json.load(f)
+
+    print(f"{'query':<28} {'full s':>8} {'2-phase s':>10} {'speedup':>8} "
+          f"{'full KB':>8} {'2-phase KB':>11} {'local ms':>14}")
+    totals = [0.0, 0.0]
+    for fx in fixtures:
+        full_local, full_size = replay_worker(copy.deepcopy(fx["full"]["info"]), False)
+        flat_local, flat_size = replay_worker(copy.deepcopy(fx["flat"]["info"]), True)
+        pick_local, pick_size = replay_worker(copy.deepcopy(fx["pick"]["info"]), False)
+
+        full_s = fx["full"]["seconds"] + full_local
+        two_s = fx["flat"]["seconds"] + fx["pick"]["seconds"] + flat_local + pick_local
+        totals[0] += full_s
+        totals[1] += two_s
+        print(
+            f"{fx['query'][:28]:<28} {full_s:>8.2f} {two_s:>10.2f} {full_s / two_s:>7.1f}x "
+            f"{full_size / 1024:>8.1f} {(flat_size + pick_size) / 1024:>11.1f} "
+            f"{full_local * 1000:>6.2f}/{(flat_local + pick_local) * 1000:<6.2f}"
+        )
+
+    if fixtures:
+        print(f"\ntotal: full {totals[0]:.2f}s, two-phase {totals[1]:.2f}s, "
+              f"{totals[0] / totals[1]:.1f}x faster")
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == "record":
+        record(args[1:], FIXTURES)
+    else:
+        replay(args[0] if args else FIXTURES)
+
+
+if __name__ == "__main__":
+    main()
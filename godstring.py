@@ -1,4 +1,4 @@
-import functools
+import itertools
 import discord
 from discord.ext import commands
 import asyncio
@@ -7,83 +7,703 @@ import time
 import json
 import os
 import re
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+import math
+import base64
+import hashlib
+import sqlite3
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import threading
+import aiohttp
+import shlex
+import signal
+import subprocess
+import sys
+from array import array
+from discord.oggparse import OggStream
+
+# The extractor pool's forkserver imports this file once as __mp_main__ so
+# its workers can find _extract_worker. That copy must not touch shared
+# state (settings migration, pruning saved rows, the opus cache index).
+WORKER_IMPORT = __name__ == "__mp_main__"
 
 
-intents = discord.Intents.all()
-bot = commands.Bot(command_prefix="!", intents=intents)
+# ==================================================
+# SHARDING
+# ==================================================
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))       # 0 = one gateway connection, no shards
+SHARD_IDS = [int(s) for s in os.getenv("SHARD_IDS", "").split(",") if s.strip()]
+SHARD_PROCESSES = max(1, int(os.getenv("SHARD_PROCESSES", "1")))
+SHARD_IDENTIFY_DELAY = 5   # discord allows one identify per 5 s by default
+
+# ==================================================
+# INTENTS
+# ==================================================
+# "minimal": only what the bot reads, members cached only while in voice
+# "all": every intent and the full member cache, like before
+INTENTS_MODE = os.getenv("INTENTS_MODE", "minimal")
+
+
+def build_intents(mode):
+    # -> (intents, extra Bot options)
+    if mode == "all":
+        return discord.Intents.all(), {}
+
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.message_content = True
+    intents.voice_states = True
 
+    member_cache = discord.MemberCacheFlags.none()
+    member_cache.voice = True
+    return intents, {"member_cache_flags": member_cache, "chunk_guilds_at_startup": False}
 
-sp = spotipy.Spotify(
-    auth_manager=SpotifyClientCredentials(
-        client_id=os.getenv("SPOTIFY_CLIENT_ID"),
-        client_secret=os.getenv("SPOTIFY_CLIENT_SECRET")
+
+intents, bot_options = build_intents(INTENTS_MODE)
+
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix="!",
+        intents=intents,
+        shard_count=SHARD_COUNT,
+        shard_ids=SHARD_IDS or None,
+        **bot_options
     )
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, **bot_options)
+
+
+# ==================================================
+# SPOTIFY (ASYNC CLIENT)
+# ==================================================
+SPOTIFY_API = "https://api.spotify.com/v1"
+SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
+SPOTIFY_MAX_CONCURRENCY = int(os.getenv("SPOTIFY_MAX_CONCURRENCY", "8"))
+SPOTIFY_MAX_RETRIES = 3
+
+
+class SpotifyError(Exception):
+    pass
+
+
+class AsyncSpotify:
+    # Client credentials only: one shared keep-alive session for every guild,
+    # the token is reused until shortly before it expires and the semaphore
+    # caps how many requests are in flight at once.
+    def __init__(self, client_id, client_secret, max_concurrency=SPOTIFY_MAX_CONCURRENCY):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.max_concurrency = max_concurrency
+        self._session = None
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._token = None
+        self._token_expires = 0
+        self._token_lock = asyncio.Lock()
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_concurrency,
+                    keepalive_timeout=60,
+                    ttl_dns_cache=300,
+                ),
+                timeout=aiohttp.ClientTimeout(total=10),
+            )
+        return self._session
+
+    async def _get_token(self):
+        if self._token and time.time() < self._token_expires - 60:
+            return self._token
+
+        async with self._token_lock:
+            if self._token and time.time() < self._token_expires - 60:
+                return self._token
+
+            if not self.client_id or not self.client_secret:
+                raise SpotifyError("Spotify credentials are not configured")
+
+            auth = aiohttp.BasicAuth(self.client_id, self.client_secret)
+            async with self._get_session().post(
+                SPOTIFY_TOKEN_URL,
+                data={"grant_type": "client_credentials"},
+                auth=auth,
+            ) as r:
+                if r.status != 200:
+                    raise SpotifyError(f"token request failed ({r.status})")
+                data = await r.json()
+
+            self._token = data["access_token"]
+            self._token_expires = time.time() + data.get("expires_in", 3600)
+            return self._token
+
+    async def _get(self, path, **params):
+        params = {
+            k: ",".join(v) if isinstance(v, (list, tuple)) else str(v)
+            for k, v in params.items()
+            if v is not None
+        }
+
+        for _ in range(SPOTIFY_MAX_RETRIES):
+            token = await self._get_token()
+            retry_after = 1
+
+            async with self._sem:
+                async with self._get_session().get(
+                    SPOTIFY_API + path,
+                    params=params,
+                    headers={"Authorization": f"Bearer {token}"},
+                ) as r:
+                    if r.status == 401:
+                        self._token = None
+                        continue
+                    if r.status == 429:
+                        retry_after = float(r.headers.get("Retry-After", 1))
+                    elif r.status >= 400:
+                        raise SpotifyError(f"{path} failed ({r.status})")
+                    else:
+                        return await r.json()
+
+            # sleep outside the semaphore so other guilds keep going
+            await asyncio.sleep(min(retry_after, 10))
+
+        raise SpotifyError(f"{path} failed after {SPOTIFY_MAX_RETRIES} tries")
+
+    async def track(self, track_id):
+        return await self._get(f"/tracks/{track_id}")
+
+    async def tracks(self, track_ids):
+        return await self._get("/tracks", ids=list(track_ids))
+
+    async def playlist_items(self, playlist_id, limit=100, offset=0, additional_types=None, fields=None):
+        return await self._get(
+            f"/playlists/{playlist_id}/tracks",
+            limit=limit,
+            offset=offset,
+            additional_types=additional_types,
+            fields=fields,
+        )
+
+    async def playlist(self, playlist_id, fields=None, additional_types=None):
+        return await self._get(
+            f"/playlists/{playlist_id}",
+            fields=fields,
+            additional_types=additional_types,
+        )
+
+    async def album_tracks(self, album_id, limit=50, offset=0):
+        return await self._get(f"/albums/{album_id}/tracks", limit=limit, offset=offset)
+
+    async def artist_top_tracks(self, artist_id, market="US"):
+        return await self._get(f"/artists/{artist_id}/top-tracks", market=market)
+
+    async def search(self, q, type="track", limit=10):
+        return await self._get("/search", q=q, type=type, limit=limit)
+
+    async def recommendations(self, seed_artists=None, limit=20, min_popularity=None):
+        return await self._get(
+            "/recommendations",
+            seed_artists=seed_artists,
+            limit=limit,
+            min_popularity=min_popularity,
+        )
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+
+sp = AsyncSpotify(
+    client_id=os.getenv("SPOTIFY_CLIENT_ID"),
+    client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
 )
 
 
-SPOTIFY_TRACK_REGEX = re.compile(r"open\.spotify\.com/track/([a-zA-Z0-9]+)")
-SPOTIFY_PLAYLIST_REGEX = re.compile(
-    r"open\.spotify\.com/playlist/([a-zA-Z0-9]+)"
+SPOTIFY_LINK_REGEX = re.compile(
+    r"open\.spotify\.com/(?:intl-[a-z]+/)?(track|playlist|album|artist)/([a-zA-Z0-9]+)"
 )
+SPOTIFY_TRACKS_BATCH = 50
+SPOTIFY_PLAYLIST_PAGE = 100
+SPOTIFY_ALBUM_PAGE = 50
+SPOTIFY_PLAYLIST_FIELDS = "items(track(name,duration_ms,artists(name))),next"
+
 
-def spotify_playlist_to_tracks(text):
-    match = SPOTIFY_PLAYLIST_REGEX.search(text)
-    if not match:
-        return None, None
+def spotify_entry(track):
+    # -> ("Artist - Song", seconds, artist), None for local files/episodes
+    if not track or not track.get("artists") or not track.get("name"):
+        return None
 
-    playlist_id = match.group(1)
+    artist = track["artists"][0]["name"]
+    duration = (track.get("duration_ms") or 0) // 1000 or None
+    return f"{artist} - {track['name']}", duration, artist
 
-    try:
-        results = sp.playlist_items(
-            playlist_id,
+
+async def spotify_tracks_by_id(track_ids):
+    found = {}
+    missing = []
+    for tid in dict.fromkeys(track_ids):
+        entry = await spotify_track_cache.get(tid)
+        if entry:
+            found[tid] = entry
+        else:
+            missing.append(tid)
+
+    for i in range(0, len(missing), SPOTIFY_TRACKS_BATCH):
+        res = await sp.tracks(missing[i:i + SPOTIFY_TRACKS_BATCH])
+        for track in res.get("tracks") or []:
+            entry = spotify_entry(track)
+            if entry:
+                found[track["id"]] = entry
+                await spotify_track_cache.set(track["id"], list(entry))
+
+    return [found[tid] for tid in track_ids if tid in found]
+
+
+def playlist_page_entries(page):
+    return list(filter(None, (spotify_entry(item.get("track")) for item in page.get("items") or [])))
+
+
+async def iter_spotify_collection(kind, cid):
+    # yields one page of entries at a time so playback can start early;
+    # a fully read collection is cached (playlists per snapshot)
+    if kind == "playlist":
+        # the first page comes with the snapshot id, so a cache check is free
+        res = await sp.playlist(
+            cid,
+            fields=f"snapshot_id,tracks({SPOTIFY_PLAYLIST_FIELDS})",
             additional_types=["track"],
-            limit=100
         )
+        key = f"playlist:{cid}:{res.get('snapshot_id')}"
+        ttl = SPOTIFY_CACHE_TTL
+    elif kind == "album":
+        key = f"album:{cid}"
+        ttl = SPOTIFY_CACHE_TTL
+    else:
+        key = f"artist:{cid}"
+        ttl = SPOTIFY_ARTIST_TOP_TTL
+
+    cached = await spotify_collection_cache.get(key)
+    if cached is not None:
+        for i in range(0, len(cached), SPOTIFY_PLAYLIST_PAGE):
+            yield cached[i:i + SPOTIFY_PLAYLIST_PAGE]
+        return
 
-        tracks = []
-        artists = set()
+    collected = []
+
+    if kind == "artist":
+        res = await sp.artist_top_tracks(cid)
+        collected = list(filter(None, map(spotify_entry, res.get("tracks") or [])))
+        yield collected
+
+    elif kind == "playlist":
+        page = res.get("tracks") or {}
+        offset = 0
+        while True:
+            entries = playlist_page_entries(page)
+            collected.extend(entries)
+            yield entries
+
+            if not page.get("next"):
+                break
+            offset += SPOTIFY_PLAYLIST_PAGE
+            page = await sp.playlist_items(
+                cid,
+                limit=SPOTIFY_PLAYLIST_PAGE,
+                offset=offset,
+                additional_types=["track"],
+                fields=SPOTIFY_PLAYLIST_FIELDS,
+            )
 
-        for item in results["items"]:
-            track = item.get("track")
-            if not track:
-                continue
+    else:
+        offset = 0
+        while True:
+            res = await sp.album_tracks(cid, limit=SPOTIFY_ALBUM_PAGE, offset=offset)
+            entries = list(filter(None, map(spotify_entry, res.get("items") or [])))
+            collected.extend(entries)
+            yield entries
+
+            if not res.get("next"):
+                break
+            offset += SPOTIFY_ALBUM_PAGE
+
+    await spotify_collection_cache.set(key, [list(e) for e in collected], ttl)
 
-            song = track["name"]
-            artist = track["artists"][0]["name"]
 
-            tracks.append(f"{artist} - {song}")
-            artists.add(artist)
 
-        return tracks if tracks else None, artists
 
-    except Exception as e:
-        print("Spotify playlist error:", e)
-        return None, None
 
+# ==================================================
+# DATABASE (SQLITE)
+# ==================================================
+DB_FILE = os.getenv("GODSTRING_DB", "godstring.db")
 
 
+def open_db():
+    conn = sqlite3.connect(
+        DB_FILE,
+        timeout=10,
+        check_same_thread=False,
+        isolation_level=None,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
 
 
 # ==================================================
 # LOAD/SAVE SETTINGS
 # ==================================================
-SETTINGS_FILE = "settings.json"
+SETTINGS_FILE = "settings.json"   # old format, imported once
+
+
+class SettingsStore:
+    # (guild_id, key) -> JSON value. Everything is read once at startup into
+    # {key: {gid: value}}; reads hit memory, each write is one row upsert.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._db = open_db()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS guild_settings ("
+            " guild_id INTEGER NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " PRIMARY KEY (guild_id, key))"
+        )
+        self._data = {}
+
+        if not WORKER_IMPORT:
+            self._migrate_json()
+        for gid, key, value in self._db.execute(
+            "SELECT guild_id, key, value FROM guild_settings"
+        ):
+            self._data.setdefault(key, {})[gid] = json.loads(value)
+
+    def _migrate_json(self):
+        if not os.path.exists(SETTINGS_FILE):
+            return
+
+        with open(SETTINGS_FILE, "r") as f:
+            old = json.load(f)
+
+        # JSON turned the guild IDs into strings
+        rows = [
+            (int(gid), "music_channel", json.dumps(cid))
+            for gid, cid in old.get("guild_music_settings", {}).items()
+        ]
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO guild_settings VALUES (?, ?, ?)", rows
+            )
+        os.replace(SETTINGS_FILE, SETTINGS_FILE + ".migrated")
+        print(f"📦 Imported {len(rows)} guild settings from {SETTINGS_FILE}")
+
+    def table(self, key):
+        # live {gid: value} dict, kept current by set()
+        return self._data.setdefault(key, {})
+
+    def get(self, gid, key, default=None):
+        return self._data.get(key, {}).get(gid, default)
+
+    def _write(self, gid, key, value):
+        with self._lock:
+            if value is None:
+                self._db.execute(
+                    "DELETE FROM guild_settings WHERE guild_id = ? AND key = ?",
+                    (gid, key),
+                )
+            else:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO guild_settings VALUES (?, ?, ?)",
+                    (gid, key, json.dumps(value)),
+                )
+
+    async def set(self, gid, key, value):
+        if value is None:
+            self.table(key).pop(gid, None)
+        else:
+            self.table(key)[gid] = value
+        await asyncio.to_thread(self._write, gid, key, value)
 
-def load_settings():
-    if not os.path.exists(SETTINGS_FILE):
-        return {}
-    with open(SETTINGS_FILE, "r") as f:
-        return json.load(f)
 
-def save_settings(data):
-    with open(SETTINGS_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+settings_store = SettingsStore()
 
-settings = load_settings()
+guild_music_settings = settings_store.table("music_channel")
+
+
+# ==================================================
+# DISK CACHE (SQLITE)
+# ==================================================
+class DiskCache:
+    # Namespaced key -> JSON value store with a TTL per entry and LRU
+    # eviction once the namespace grows past max_entries.
+    EVICT_EVERY = 100
+
+    def __init__(self, ns, ttl, max_entries):
+        self.ns = ns
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._db = open_db()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL, accessed_at REAL NOT NULL,"
+            " PRIMARY KEY (ns, key))"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS cache_lru ON cache (ns, accessed_at)"
+        )
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM cache WHERE ns = ? AND key = ?",
+                (self.ns, key),
+            ).fetchone()
+
+            if not row or row[1] < now:
+                if row:
+                    self._db.execute(
+                        "DELETE FROM cache WHERE ns = ? AND key = ?", (self.ns, key)
+                    )
+                self.misses += 1
+                return None
+
+            self._db.execute(
+                "UPDATE cache SET accessed_at = ? WHERE ns = ? AND key = ?",
+                (now, self.ns, key),
+            )
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                (self.ns, key, json.dumps(value), now + (ttl or self.ttl), now),
+            )
+            self._writes += 1
+            if self._writes % self.EVICT_EVERY == 0:
+                self._evict(now)
+
+    def _evict(self, now):
+        self._db.execute(
+            "DELETE FROM cache WHERE ns = ? AND expires_at < ?", (self.ns, now)
+        )
+        self._db.execute(
+            "DELETE FROM cache WHERE ns = ? AND key IN ("
+            " SELECT key FROM cache WHERE ns = ?"
+            " ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.ns, self.ns, self.max_entries),
+        )
+
+    def size(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM cache WHERE ns = ?", (self.ns,)
+            ).fetchone()[0]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": self.size(),
+        }
+
+    async def aget(self, key):
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key, value, ttl=None):
+        await asyncio.to_thread(self.set, key, value, ttl)
+
+
+class TieredCache:
+    # Small in-memory LRU in front of a DiskCache namespace. Values coming
+    # back from here are shared, treat them as read-only.
+    def __init__(self, ns, ttl, mem_max, disk_max):
+        self.ttl = ttl
+        self.mem_max = mem_max
+        self.disk = DiskCache(ns, ttl, disk_max)
+        self.mem_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._mem = OrderedDict()   # {key: (expires_at, value)}
+
+    def _remember(self, key, value, ttl):
+        self._mem[key] = (time.time() + ttl, value)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.mem_max:
+            self._mem.popitem(last=False)
+
+    async def get(self, key):
+        hit = self._mem.get(key)
+        if hit and hit[0] > time.time():
+            self._mem.move_to_end(key)
+            self.mem_hits += 1
+            return hit[1]
+
+        value = await self.disk.aget(key)
+        if value is None:
+            self._mem.pop(key, None)
+            self.misses += 1
+            return None
+
+        self.disk_hits += 1
+        self._remember(key, value, self.ttl)
+        return value
+
+    async def set(self, key, value, ttl=None):
+        self._remember(key, value, ttl or self.ttl)
+        await self.disk.aset(key, value, ttl)
+
+    def stats(self):
+        total = self.mem_hits + self.disk_hits + self.misses
+        return {
+            "mem_hits": self.mem_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.mem_hits + self.disk_hits) / total if total else 0.0,
+            "mem_size": len(self._mem),
+        }
+
+
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", str(30 * 24 * 3600)))
+SEARCH_CACHE_MAX = int(os.getenv("SEARCH_CACHE_MAX", "50000"))
+
+# normalized text query -> {"id", "title", "duration", "thumbnail"}
+search_cache = DiskCache("search", SEARCH_CACHE_TTL, SEARCH_CACHE_MAX)
+
+
+def normalize_query(query):
+    return re.sub(r"\s+", " ", query.casefold()).strip(" \"'")
+
+
+SPOTIFY_CACHE_TTL = int(os.getenv("SPOTIFY_CACHE_TTL", str(7 * 24 * 3600)))
+SPOTIFY_ARTIST_TOP_TTL = 24 * 3600
+SPOTIFY_POOL_TTL = 12 * 3600
+SPOTIFY_EMPTY_TTL = 3600
+
+# track id -> [title, seconds, artist]
+spotify_track_cache = TieredCache("sp_track", SPOTIFY_CACHE_TTL, 5000, 200000)
+# normalized artist name -> artist id ("" when Spotify has none)
+spotify_artist_cache = TieredCache("sp_artist", SPOTIFY_CACHE_TTL, 2000, 50000)
+# "playlist:<id>:<snapshot>" / "album:<id>" / "artist:<id>" -> entries
+spotify_collection_cache = TieredCache("sp_collection", SPOTIFY_CACHE_TTL, 50, 5000)
+# normalized artist name -> Smart Play candidate entries
+spotify_pool_cache = TieredCache("sp_pool", SPOTIFY_POOL_TTL, 1000, 20000)
+
+SPOTIFY_CACHES = {
+    "tracks": spotify_track_cache,
+    "artist IDs": spotify_artist_cache,
+    "playlists/albums": spotify_collection_cache,
+    "smart pools": spotify_pool_cache,
+}
+
+
+# ==================================================
+# BOT MESSAGE REGISTRY
+# ==================================================
+BULK_DELETE_MAX_AGE = 14 * 24 * 3600 - 300   # Discord refuses bulk deletes past 14 days
+BULK_DELETE_CHUNK = 100
+
+
+class MessageRegistry:
+    # IDs of every message the bot posted in a music channel, kept on disk
+    # so a restart can still clean up what the previous run left behind.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._db = open_db()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS bot_messages ("
+            " message_id INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS bot_messages_channel ON bot_messages (channel_id)"
+        )
+
+    def _add(self, channel_id, message_id):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO bot_messages VALUES (?, ?)",
+                (message_id, channel_id),
+            )
+
+    def _take(self, channel_id, keep=()):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT message_id FROM bot_messages WHERE channel_id = ?",
+                (channel_id,),
+            ).fetchall()
+            ids = [r[0] for r in rows if r[0] not in keep]
+            self._db.executemany(
+                "DELETE FROM bot_messages WHERE message_id = ?", [(i,) for i in ids]
+            )
+        return ids
+
+    async def add(self, message):
+        await asyncio.to_thread(self._add, message.channel.id, message.id)
+
+    async def take(self, channel_id, keep=()):
+        return await asyncio.to_thread(self._take, channel_id, keep)
+
+
+message_registry = MessageRegistry()
+background_tasks = set()
+
+
+def spawn(coro):
+    # keep a reference so fire-and-forget tasks aren't garbage collected
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def send_tracked(channel, **kwargs):
+    m = await channel.send(**kwargs)
+    await message_registry.add(m)
+    return m
+
+
+async def purge_bot_messages(channel, keep=()):
+    ids = await message_registry.take(channel.id, keep)
+    if not ids:
+        return
+
+    cutoff = time.time() - BULK_DELETE_MAX_AGE
+    recent = [i for i in ids if discord.utils.snowflake_time(i).timestamp() > cutoff]
+    old = [i for i in ids if discord.utils.snowflake_time(i).timestamp() <= cutoff]
+
+    for i in range(0, len(recent), BULK_DELETE_CHUNK):
+        chunk = recent[i:i + BULK_DELETE_CHUNK]
+        try:
+            await channel.delete_messages([discord.Object(id=m) for m in chunk])
+        except discord.HTTPException as e:
+            print("Bulk delete failed, falling back:", e)
+            old.extend(chunk)
+
+    for mid in old:
+        try:
+            await channel.get_partial_message(mid).delete()
+        except (discord.NotFound, discord.Forbidden):
+            pass
+        except discord.HTTPException as e:
+            print("Delete error:", e)
+
+
+def purge_channel_later(guild):
+    ch = guild.get_channel(guild_music_settings.get(guild.id))
+    if ch:
+        spawn(purge_bot_messages(ch))
 
-guild_music_settings = settings.get("guild_music_settings", {})
 
 # ==================================================
 # LICENSE SYSTEM
@@ -117,10 +737,161 @@ async def send_license_error(ctx):
     )
     await ctx.send(embed=embed, view=ContactButton())
 
+# ==================================================
+# TRACK QUEUE
+# ==================================================
+MAX_TRACKS_PER_USER = int(os.getenv("MAX_TRACKS_PER_USER", "500"))
+
+
+class Track:
+    __slots__ = ("query", "owner_id", "video_id", "duration")
+
+    def __init__(self, query, owner_id, video_id=None, duration=None):
+        self.query = query
+        self.owner_id = owner_id
+        self.video_id = video_id
+        self.duration = duration
+
+    def key(self):
+        return self.video_id or normalize_query(self.query or "")
+
+
+class TrackQueue:
+    # deque of Track records with per-user caps. `version` goes up on every
+    # change, the queue pager keys its rendered pages on it.
+    def __init__(self, max_per_user=MAX_TRACKS_PER_USER):
+        self.max_per_user = max_per_user
+        self.version = 0
+        self.total_duration = 0
+        self.unknown_durations = 0
+        self._items = deque()
+        self._per_user = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __bool__(self):
+        return bool(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def _count(self, track, delta):
+        n = self._per_user.get(track.owner_id, 0) + delta
+        if n > 0:
+            self._per_user[track.owner_id] = n
+        else:
+            self._per_user.pop(track.owner_id, None)
+
+        if track.duration:
+            self.total_duration += delta * track.duration
+        else:
+            self.unknown_durations += delta
+
+    def _take(self, track):
+        self._count(track, -1)
+        self.version += 1
+        return track
+
+    def set_duration(self, track, seconds):
+        self._count(track, -1)
+        track.duration = seconds
+        self._count(track, 1)
+        self.version += 1
+
+    def user_count(self, owner_id):
+        return self._per_user.get(owner_id, 0)
+
+    def push(self, track):
+        if self.user_count(track.owner_id) >= self.max_per_user:
+            return False
+        self._items.append(track)
+        self._count(track, 1)
+        self.version += 1
+        return True
+
+    def extend(self, tracks):
+        added = 0
+        for track in tracks:
+            if not self.push(track):
+                break
+            added += 1
+        return added
+
+    def push_front(self, track):
+        # loop re-inserts bypass the cap, the track was already in the queue
+        self._items.appendleft(track)
+        self._count(track, 1)
+        self.version += 1
+
+    def peek(self):
+        return self._items[0] if self._items else None
+
+    def pop(self):
+        return self._take(self._items.popleft()) if self._items else None
+
+    def pop_back(self):
+        return self._take(self._items.pop()) if self._items else None
+
+    def remove(self, index):
+        track = self._items[index]
+        del self._items[index]
+        return self._take(track)
+
+    def move(self, src, dst):
+        track = self._items[src]
+        del self._items[src]
+        self._items.insert(dst, track)
+        self.version += 1
+
+    def shuffle(self):
+        items = list(self._items)
+        random.shuffle(items)
+        self._items = deque(items)
+        self.version += 1
+
+    def dedupe(self):
+        seen = set()
+        kept = deque()
+        for track in self._items:
+            key = track.key()
+            if key in seen:
+                self._count(track, -1)
+                continue
+            seen.add(key)
+            kept.append(track)
+
+        removed = len(self._items) - len(kept)
+        if removed:
+            self._items = kept
+            self.version += 1
+        return removed
+
+    def clear(self):
+        self._items.clear()
+        self._per_user.clear()
+        self.total_duration = 0
+        self.unknown_durations = 0
+        self.version += 1
+
+    def slice(self, start, stop):
+        return list(itertools.islice(self._items, start, stop))
+
+
+def get_queue(gid):
+    queue = guild_queues.get(gid)
+    if queue is None:
+        queue = guild_queues[gid] = TrackQueue()
+    return queue
+
+
 # ==================================================
 # STORAGE
 # ==================================================
-guild_queues = {}
+guild_queues = {}   # {gid: TrackQueue}
 guild_current = {}
 guild_nowplaying_msg = {}
 guild_queue_msg = {}
@@ -129,8 +900,8 @@ skip_pending = {}
 loop_enabled = {}
 first_run_cleanup = {}
 smart_play_enabled = {}
-smart_play_seed = {}   
-played_video_ids = {}  
+smart_play_seed = {}    # {gid: BoundedSet} use get_seeds()
+played_video_ids = {}   # {gid: RecentHistory} use get_history()
 
 MAX_SMART_TRIES = 5
 smart_fail_count = {}   # {guild_id: int}
@@ -138,8 +909,256 @@ smart_fail_count = {}   # {guild_id: int}
 
 
 
+# ==================================================
+# PLAYED HISTORY
+# ==================================================
+HISTORY_MAX = int(os.getenv("HISTORY_MAX", "300"))
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", str(12 * 3600)))
+HISTORY_BLOOM_CAPACITY = int(os.getenv("HISTORY_BLOOM_CAPACITY", "0"))   # 0 = off
+HISTORY_BLOOM_ERROR = 0.01
+HISTORY_FLUSH_EVERY = 60
+MAX_SEED_ARTISTS = 50
+
+
+class RotatingBloom:
+    # Two bloom filter generations; once the newer one has seen `capacity`
+    # keys the older is dropped, so memory stays fixed and old plays age out.
+    def __init__(self, capacity, error_rate=HISTORY_BLOOM_ERROR):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self.current = bytearray(self.size // 8 + 1)
+        self.previous = bytearray(self.size // 8 + 1)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    @staticmethod
+    def _has(bits, positions):
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def add(self, key):
+        if self.count >= self.capacity:
+            self.previous = self.current
+            self.current = bytearray(self.size // 8 + 1)
+            self.count = 0
+
+        for p in self._positions(key):
+            self.current[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        positions = self._positions(key)
+        return self._has(self.current, positions) or self._has(self.previous, positions)
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "current": base64.b64encode(self.current).decode(),
+            "previous": base64.b64encode(self.previous).decode(),
+        }
+
+    def load(self, data):
+        current = base64.b64decode(data["current"])
+        previous = base64.b64decode(data["previous"])
+        if len(current) == len(self.current) == len(previous):
+            self.count = data["count"]
+            self.current = bytearray(current)
+            self.previous = bytearray(previous)
+
+
+class RecentHistory:
+    # Played video IDs, capped by count and age (oldest out first), with an
+    # optional bloom filter for a longer "already played" horizon.
+    def __init__(self, max_items=HISTORY_MAX, window=HISTORY_WINDOW, bloom_capacity=HISTORY_BLOOM_CAPACITY):
+        self.max_items = max_items
+        self.window = window
+        self.bloom = RotatingBloom(bloom_capacity) if bloom_capacity else None
+        self.dirty = False
+        self._items = OrderedDict()   # {video_id: played_at}
+
+    def __contains__(self, vid):
+        played_at = self._items.get(vid)
+        if played_at is not None and played_at > time.time() - self.window:
+            return True
+        return bool(self.bloom) and vid in self.bloom
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, vid):
+        now = time.time()
+        self._items[vid] = now
+        self._items.move_to_end(vid)
+        if self.bloom:
+            self.bloom.add(vid)
+
+        cutoff = now - self.window
+        while self._items and (
+            len(self._items) > self.max_items
+            or next(iter(self._items.values())) < cutoff
+        ):
+            self._items.popitem(last=False)
+        self.dirty = True
+
+    def clear(self):
+        self._items.clear()
+        if self.bloom:
+            self.bloom = RotatingBloom(self.bloom.capacity)
+        self.dirty = True
+
+    def to_json(self):
+        return {
+            "items": list(self._items.items()),
+            "bloom": self.bloom.to_json() if self.bloom else None,
+        }
+
+    def load(self, data):
+        cutoff = time.time() - self.window
+        for vid, played_at in data.get("items", [])[-self.max_items:]:
+            if played_at > cutoff:
+                self._items[vid] = played_at
+        if self.bloom and data.get("bloom"):
+            self.bloom.load(data["bloom"])
+
+
+class BoundedSet:
+    # insertion-ordered set that forgets its oldest member past maxlen
+    def __init__(self, maxlen=MAX_SEED_ARTISTS):
+        self.maxlen = maxlen
+        self.dirty = False
+        self._items = OrderedDict()
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item):
+        self._items[item] = None
+        self._items.move_to_end(item)
+        while len(self._items) > self.maxlen:
+            self._items.popitem(last=False)
+        self.dirty = True
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def clear(self):
+        self._items.clear()
+        self.dirty = True
+
+    def to_json(self):
+        return list(self._items)
+
+    def load(self, data):
+        self.update(data)
+        self.dirty = False
+
+
+class HistoryStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._db = open_db()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS guild_history ("
+            " guild_id INTEGER PRIMARY KEY, played TEXT NOT NULL, seeds TEXT NOT NULL)"
+        )
+
+    def load(self, gid):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT played, seeds FROM guild_history WHERE guild_id = ?", (gid,)
+            ).fetchone()
+        return (json.loads(row[0]), json.loads(row[1])) if row else (None, None)
+
+    def save_many(self, rows):
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO guild_history VALUES (?, ?, ?)",
+                [(gid, json.dumps(p), json.dumps(s)) for gid, p, s in rows],
+            )
+
+
+history_store = HistoryStore()
+
+
+def _load_history(gid):
+    played, seeds = history_store.load(gid)
+
+    history = RecentHistory()
+    if played:
+        history.load(played)
+    played_video_ids[gid] = history
+
+    seed_set = BoundedSet()
+    if seeds:
+        seed_set.load(seeds)
+    smart_play_seed[gid] = seed_set
+
+
+def get_history(gid):
+    if gid not in played_video_ids:
+        _load_history(gid)
+    return played_video_ids[gid]
+
+
+def get_seeds(gid):
+    if gid not in smart_play_seed:
+        _load_history(gid)
+    return smart_play_seed[gid]
+
+
+async def flush_history():
+    rows = []
+    for gid, history in list(played_video_ids.items()):
+        seeds = get_seeds(gid)
+        if history.dirty or seeds.dirty:
+            history.dirty = seeds.dirty = False
+            rows.append((gid, history.to_json(), seeds.to_json()))
+
+    if rows:
+        await asyncio.to_thread(history_store.save_many, rows)
+
+
+history_task = None
+
+
+async def history_flush_loop():
+    while True:
+        await asyncio.sleep(HISTORY_FLUSH_EVERY)
+        try:
+            await flush_history()
+        except Exception as e:
+            print("History flush error:", e)
+
+
 song_start_time = {}
 song_duration = {}
+song_paused_at = {}      # {gid: time the current song was paused}
+song_paused_total = {}   # {gid: seconds spent paused during the current song}
+
+
+def song_elapsed(gid):
+    now = song_paused_at.get(gid) or time.time()
+    return now - song_start_time.get(gid, now) - song_paused_total.get(gid, 0)
+
+
+def reset_song_clock(gid, duration=None, elapsed=0):
+    song_start_time[gid] = time.time() - elapsed
+    song_paused_at.pop(gid, None)
+    song_paused_total.pop(gid, None)
+    if duration is not None:
+        song_duration[gid] = duration
 
 PURPLE = 0x6A0DAD
 
@@ -152,18 +1171,18 @@ def extract_artist(title):
     return title.strip().split(" ")[0]
 
 YTDL_OPTS = {
-    "format": "bestaudio/best",
+    # opus in webm can be sent to discord without re-encoding
+    "format": "bestaudio[acodec=opus]/bestaudio/best",
     "quiet": True,
     "noplaylist": True,
     "ignoreerrors": True,
     "default_search": "ytsearch",
     "extract_flat": False,
+    "socket_timeout": 10,
 }
 
-
-
-
-ytdl = YoutubeDL(YTDL_OPTS)
+# search results only need IDs/titles, the chosen one gets a full extract
+YTDL_FLAT_OPTS = {**YTDL_OPTS, "extract_flat": "in_playlist"}
 
 FFMPEG_OPTIONS = {
     "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
@@ -171,10 +1190,197 @@ FFMPEG_OPTIONS = {
 }
 
 
+# ==================================================
+# EXTRACTOR POOL
+# ==================================================
+EXTRACT_WORKERS = max(1, int(os.getenv("EXTRACT_WORKERS", "2")))
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", "45"))
+
+PRIORITY_USER = 0
+PRIORITY_PREFETCH = 1
+PRIORITY_SMART = 2
+
+ENTRY_KEYS = ("id", "url", "title", "duration", "thumbnail", "acodec", "abr", "asr", "ext")
+
+
+class ExtractTimeout(Exception):
+    pass
+
+
+class ExtractCancelled(Exception):
+    pass
+
+
+# --- runs inside the worker processes ---
+_worker_ytdl = {}
+
+
+def _extract_worker_init():
+    _worker_ytdl[False] = YoutubeDL(YTDL_OPTS)
+    _worker_ytdl[True] = YoutubeDL(YTDL_FLAT_OPTS)
+
+
+def _slim_entry(e):
+    slim = {k: e.get(k) for k in ENTRY_KEYS}
+    thumbs = e.get("thumbnails")
+    if thumbs:
+        slim["thumbnails"] = [thumbs[-1]]
+    return slim
+
+
+def _extract_worker(url, flat):
+    info = _worker_ytdl[flat].extract_info(url, download=False)
+    if not info:
+        return None
+
+    # only ship back what the bot uses, full info dicts are huge
+    slim = _slim_entry(info)
+    if "entries" in info:
+        slim["entries"] = [_slim_entry(e) if e else None for e in info["entries"]]
+    return slim
+
+
+class ExtractorPool:
+    # yt-dlp runs in its own processes so its parsing never holds our GIL.
+    # Jobs wait in a priority queue: user requests first, then prefetch,
+    # then Smart Play candidates.
+    def __init__(self, workers, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = None
+        self._queue = None
+        self._seq = itertools.count()
+        self._dispatchers = []
+        self._guild_jobs = {}   # {gid: set(futures)}
+
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.cancelled = 0
+
+    def start(self):
+        if self._executor:
+            return
+
+        self._executor = self._new_executor()
+        self._queue = asyncio.PriorityQueue()
+        self._dispatchers = [
+            asyncio.create_task(self._dispatch()) for _ in range(self.workers)
+        ]
+
+    def _new_executor(self):
+        # Workers come from a forkserver, never forked from the bot itself
+        # with its gateway/voice sockets, DB handles and audio threads.
+        methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context(
+            "forkserver" if "forkserver" in methods else "spawn"
+        )
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=ctx,
+            initializer=_extract_worker_init,
+        )
+
+    def _recycle(self, executor, cancel_futures=False, terminate=False):
+        # a stuck or dead worker would hold its slot: new jobs go to fresh
+        # processes, and on a timeout the old ones are killed, since
+        # shutdown() alone leaves a hung yt-dlp running forever
+        if executor is not self._executor:
+            return   # another dispatcher already replaced it
+
+        processes = list((getattr(executor, "_processes", None) or {}).values())
+        executor.shutdown(wait=False, cancel_futures=cancel_futures)
+        if terminate:
+            for p in processes:
+                if p.is_alive():
+                    p.terminate()
+        self._executor = self._new_executor()
+
+    async def extract(self, url, flat=False, priority=PRIORITY_USER, gid=None):
+        self.start()
+
+        fut = asyncio.get_running_loop().create_future()
+        job = {"url": url, "flat": flat, "future": fut}
+        self._queue.put_nowait((priority, next(self._seq), job))
+
+        if gid is not None:
+            jobs = self._guild_jobs.setdefault(gid, set())
+            jobs.add(fut)
+            fut.add_done_callback(jobs.discard)
+
+        return await fut
+
+    def cancel_guild(self, gid):
+        for fut in list(self._guild_jobs.pop(gid, ())):
+            if not fut.done():
+                fut.set_exception(ExtractCancelled(f"guild {gid} stopped"))
+                self.cancelled += 1
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            priority, _, job = await self._queue.get()
+            fut = job["future"]
+            if fut.done():
+                continue   # cancelled while waiting
+
+            executor = self._executor
+            self.running += 1
+            try:
+                result = await asyncio.wait_for(
+                    loop.run_in_executor(
+                        executor, _extract_worker, job["url"], job["flat"]
+                    ),
+                    self.timeout,
+                )
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                self._recycle(executor, terminate=True)
+                if not fut.done():
+                    fut.set_exception(ExtractTimeout(job["url"]))
+            except BrokenProcessPool as e:
+                if executor is not self._executor and not job.get("retried"):
+                    # killed along with a timed-out sibling, not its own fault
+                    job["retried"] = True
+                    self._queue.put_nowait((priority, next(self._seq), job))
+                    continue
+
+                self.failed += 1
+                print("Extractor pool broke, restarting:", e)
+                self._recycle(executor, cancel_futures=True)
+                if not fut.done():
+                    fut.set_exception(e)
+            except Exception as e:
+                self.failed += 1
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                self.completed += 1
+                if not fut.done():
+                    fut.set_result(result)
+            finally:
+                self.running -= 1
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+        }
+
+
+extractor_pool = ExtractorPool(EXTRACT_WORKERS, EXTRACT_TIMEOUT)
+
+
 import random
 
 def build_smart_query(gid):
-    artists = list(smart_play_seed.get(gid, []))
+    artists = list(get_seeds(gid))
     if not artists:
         return None
 
@@ -198,16 +1404,164 @@ def build_progress(elapsed, total):
     return f"[{'■' * filled}{'□' * empty}] {int(elapsed)}/{int(total)}s"
 
 
+# ==================================================
+# EDIT SCHEDULER
+# ==================================================
+EDIT_MIN_INTERVAL = float(os.getenv("EDIT_MIN_INTERVAL", "1.5"))
+EDIT_DEBOUNCE = 0.3
+EDIT_RATE_LIMIT_BACKOFF = 5
+
+
+class EditScheduler:
+    # At most one edit per interval per message. Edits that arrive while
+    # one is pending are merged into it (last write wins per field).
+    def __init__(self, interval, debounce=EDIT_DEBOUNCE):
+        self.interval = interval
+        self.debounce = debounce
+        self._pending = {}   # {message_id: (message, kwargs)}
+        self._tasks = {}     # {message_id: Task}
+        self._last = {}      # {message_id: monotonic time of last edit}
+
+        self.requested = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+
+    def schedule(self, message, **kwargs):
+        self.requested += 1
+        mid = message.id
+
+        pending = self._pending.get(mid)
+        if pending:
+            self.coalesced += 1
+            kwargs = {**pending[1], **kwargs}
+        self._pending[mid] = (message, kwargs)
+
+        if mid not in self._tasks:
+            self._tasks[mid] = asyncio.create_task(self._flush(mid))
+
+    def forget(self, message):
+        if not message:
+            return
+        self._pending.pop(message.id, None)
+        self._last.pop(message.id, None)
+        task = self._tasks.pop(message.id, None)
+        if task:
+            task.cancel()
+
+    async def _flush(self, mid):
+        try:
+            await asyncio.sleep(self.debounce)
+
+            while mid in self._pending:
+                wait = self._last.get(mid, 0) + self.interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+                message, kwargs = self._pending.pop(mid)
+                try:
+                    await message.edit(**kwargs)
+                    self.sent += 1
+                except discord.NotFound:
+                    self._pending.pop(mid, None)
+                    return
+                except discord.HTTPException as e:
+                    if e.status != 429:
+                        print("Edit error:", e)
+                    else:
+                        # put it back unless something newer replaced it
+                        self.rate_limited += 1
+                        self._pending.setdefault(mid, (message, kwargs))
+                        await asyncio.sleep(EDIT_RATE_LIMIT_BACKOFF)
+
+                self._last[mid] = time.monotonic()
+        finally:
+            self._tasks.pop(mid, None)
+
+    def stats(self):
+        return {
+            "requested": self.requested,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "rate_limited": self.rate_limited,
+            "pending": len(self._pending),
+        }
+
+
+edit_scheduler = EditScheduler(EDIT_MIN_INTERVAL)
+
+
 # ==================================================
 # QUEUE DISPLAY
 # ==================================================
-async def update_queue_display(guild):
-    gid = guild.id
-    queue = guild_queues.get(gid, [])
+QUEUE_PAGE_SIZE = 15
+QUEUE_LINE_MAX = 60
 
-    inside = "✨ *Queue is empty…*" if not queue else "\n".join(
-        [f"✨ {item['query']}" for item in queue]
-    )
+
+def fmt_duration(seconds):
+    seconds = int(seconds)
+    h, rest = divmod(seconds, 3600)
+    m, s = divmod(rest, 60)
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
+
+
+class QueuePager:
+    # Keeps the page the guild is looking at plus the rendered text of
+    # pages already built for the current queue version.
+    def __init__(self):
+        self.page = 0
+        self.rendered = None   # (page, version, header) of the last edit
+        self._version = None
+        self._pages = {}       # {page: text} at self._version
+
+    def page_count(self, queue):
+        return max(1, -(-len(queue) // QUEUE_PAGE_SIZE))
+
+    def clamp(self, queue):
+        self.page = min(max(self.page, 0), self.page_count(queue) - 1)
+        return self.page
+
+    def page_text(self, queue, page):
+        if queue.version != self._version:
+            self._version = queue.version
+            self._pages.clear()
+
+        cached = self._pages.get(page)
+        if cached is not None:
+            return cached
+
+        start = page * QUEUE_PAGE_SIZE
+        tracks = queue.slice(start, start + QUEUE_PAGE_SIZE)
+        lines = []
+        for i, t in enumerate(tracks, start + 1):
+            name = t.query if len(t.query) <= QUEUE_LINE_MAX else t.query[:QUEUE_LINE_MAX] + "..."
+            dur = f" `{fmt_duration(t.duration)}`" if t.duration else ""
+            lines.append(f"✨ **{i}.** {name}{dur}")
+
+        text = "\n".join(lines)
+        self._pages[page] = text
+        return text
+
+
+guild_queue_pager = {}
+
+
+def get_pager(gid):
+    pager = guild_queue_pager.get(gid)
+    if pager is None:
+        pager = guild_queue_pager[gid] = QueuePager()
+    return pager
+
+
+def build_queue_embed(gid):
+    queue = get_queue(gid)
+    pager = get_pager(gid)
+    page = pager.clamp(queue)
+
+    if queue:
+        inside = pager.page_text(queue, page)
+    else:
+        inside = "✨ *Queue is empty…*"
 
     boxed = (
         "╔══════════════════════════╗\n"
@@ -215,15 +1569,57 @@ async def update_queue_display(guild):
         "╚══════════════════════════╝"
     )
 
-    embed = discord.Embed(title="🎶✨ **QUEUE** ✦", description=boxed, color=PURPLE)
+    total = fmt_duration(queue.total_duration)
+    if queue.unknown_durations:
+        total += f" + {queue.unknown_durations} unknown"
+    header = f"{len(queue)} songs · ⏱️ {total}"
+
+    embed = discord.Embed(
+        title="🎶✨ **QUEUE** ✦",
+        description=f"**{header}**\n{boxed}",
+        color=PURPLE,
+    )
+    embed.set_footer(text=f"Page {page + 1}/{pager.page_count(queue)}")
+    return embed, (page, queue.version, header)
+
+
+class QueueControls(discord.ui.View):
+    def __init__(self, gid):
+        super().__init__(timeout=None)
+        self.gid = gid
 
-    channel = guild.get_channel(guild_music_settings[gid])
+    async def turn(self, inter, step):
+        pager = get_pager(self.gid)
+        pager.page += step
+        embed, pager.rendered = build_queue_embed(self.gid)
+        await inter.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def prev_page(self, inter, btn):
+        await self.turn(inter, -1)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, inter, btn):
+        await self.turn(inter, 1)
+
+
+async def update_queue_display(guild):
+    gid = guild.id
+    pager = get_pager(gid)
+
+    embed, rendered = build_queue_embed(gid)
 
     old = guild_queue_msg.get(gid)
+    if old and rendered == pager.rendered:
+        return   # the visible page didn't change
+
+    pager.rendered = rendered
+
     if old:
-        await old.edit(embed=embed)
+        edit_scheduler.schedule(old, embed=embed)
     else:
-        guild_queue_msg[gid] = await channel.send(embed=embed)
+        channel = guild.get_channel(guild_music_settings[gid])
+        guild_queue_msg[gid] = await send_tracked(channel, embed=embed, view=QueueControls(gid))
 
 
 # ==================================================
@@ -242,6 +1638,38 @@ async def clear_skip_requests(guild):
     skip_pending[gid] = None
 
 
+# ==================================================
+# MEMBER LOOKUP
+# ==================================================
+MEMBER_NAME_TTL = 600
+MEMBER_NAME_MAX = 5000
+member_names = OrderedDict()   # {(gid, uid): (display name, expires_at)}
+
+
+async def member_name(guild, uid):
+    # display name without a member cache: cached, one API call on a miss
+    member = guild.get_member(uid)
+    if member:
+        return member.display_name
+
+    key = (guild.id, uid)
+    hit = member_names.get(key)
+    if hit and hit[1] > time.time():
+        member_names.move_to_end(key)
+        return hit[0]
+
+    try:
+        name = (await guild.fetch_member(uid)).display_name
+    except discord.HTTPException:
+        name = "someone"
+
+    member_names[key] = (name, time.time() + MEMBER_NAME_TTL)
+    member_names.move_to_end(key)
+    while len(member_names) > MEMBER_NAME_MAX:
+        member_names.popitem(last=False)
+    return name
+
+
 # ==================================================
 # MUSIC CONTROLS
 # ==================================================
@@ -249,12 +1677,28 @@ class MusicControls(discord.ui.View):
     def __init__(self, gid):
         super().__init__(timeout=None)
         self.gid = gid
+        self.sync()
+
+    # 🔄 Sync button styles with the guild state
+    def sync(self, guild=None):
+        gid = self.gid
+        on, off = discord.ButtonStyle.success, discord.ButtonStyle.secondary
+
+        self.smart_play.style = on if smart_play_enabled.get(gid) else off
+        self.loop.style = on if loop_enabled.get(gid) else off
+
+        vc = guild.voice_client if guild else None
+        if vc and vc.is_paused():
+            self.pause_resume.label = "Resume"
+            self.pause_resume.style = on
+        else:
+            self.pause_resume.label = "Pause"
+            self.pause_resume.style = off
 
-        # 🔄 Sync Smart Play button style
-        for item in self.children:
-            if isinstance(item, discord.ui.Button) and item.label == "Smart Play":
-                if smart_play_enabled.get(gid):
-                    item.style = discord.ButtonStyle.success
+        if not skip_pending.get(gid):
+            self.skip.label = "Skip"
+            self.skip.style = discord.ButtonStyle.primary
+        return self
 
     
     @discord.ui.button(label="Smart Play", style=discord.ButtonStyle.secondary, row=1)
@@ -264,21 +1708,25 @@ class MusicControls(discord.ui.View):
 
         if smart_play_enabled[gid]:
             btn.style = discord.ButtonStyle.success
-            smart_play_seed[gid] = set()
+            get_seeds(gid).clear()
 
             # ⬅️ خذ الأغنية الحالية + باقي الكويي فقط
             if guild_current.get(gid):
                 feed_smart_seed(gid, guild_current[gid]["query"])
 
-            for item in guild_queues.get(gid, []):
-                feed_smart_seed(gid, item["query"])
+            for track in get_queue(gid):
+                feed_smart_seed(gid, track.query)
 
         else:
             btn.style = discord.ButtonStyle.secondary
-            smart_play_seed[gid] = set()
+            get_seeds(gid).clear()
 
-        await inter.message.edit(view=self)
-        await inter.response.defer()
+        # seeds changed, old candidates no longer apply
+        clear_smart_pool(gid)
+        if guild_current.get(gid):
+            start_prefetch(inter.guild)
+
+        await inter.response.edit_message(view=self)
 
 
 
@@ -294,17 +1742,22 @@ class MusicControls(discord.ui.View):
         # إذا الأغنية تلعب → Pause
         if vc.is_playing():
             vc.pause()
+            song_paused_at[inter.guild.id] = time.time()
             btn.label = "Resume"
             btn.style = discord.ButtonStyle.success
 
         # إذا الأغنية متوقفة → Resume
         elif vc.is_paused():
             vc.resume()
+            paused_at = song_paused_at.pop(inter.guild.id, None)
+            if paused_at:
+                song_paused_total[inter.guild.id] = (
+                    song_paused_total.get(inter.guild.id, 0) + time.time() - paused_at
+                )
             btn.label = "Pause"
             btn.style = discord.ButtonStyle.secondary
 
-        await inter.message.edit(view=self)
-        await inter.response.defer()
+        await inter.response.edit_message(view=self)
 
     @discord.ui.button(label="Skip", style=discord.ButtonStyle.primary, row=0)
     async def skip(self, inter, btn):
@@ -323,7 +1776,7 @@ class MusicControls(discord.ui.View):
 
                 btn.label = "Skip"
                 btn.style = discord.ButtonStyle.primary
-                await inter.message.edit(view=self)
+                edit_scheduler.schedule(inter.message, view=self)
                 return
 
 
@@ -352,185 +1805,1378 @@ class MusicControls(discord.ui.View):
 
         skip_pending[gid] = {"song_owner_id": owner, "requester_id": requester}
 
-        owner_member = inter.guild.get_member(owner)
-        owner_name = owner_member.display_name
+        owner_name = await member_name(inter.guild, owner)
 
         btn.label = f"Waiting ({owner_name})"
         btn.style = discord.ButtonStyle.danger
-        await inter.message.edit(view=self)
+        await inter.response.edit_message(view=self)
 
         # message
         channel = inter.guild.get_channel(guild_music_settings[gid])
         embed = discord.Embed(
-            description=f"💜 Skip request from {inter.user.mention}\nWaiting for {owner_member.mention} to approve ✨",
+            description=f"💜 Skip request from {inter.user.mention}\nWaiting for <@{owner}> to approve ✨",
             color=PURPLE
         )
-        m = await channel.send(embed=embed)
+        m = await send_tracked(channel, embed=embed)
 
         skip_request_msg.setdefault(gid, []).append(m)
 
-        await inter.response.defer()
-
     @discord.ui.button(label="Loop", style=discord.ButtonStyle.secondary, row=0)
     async def loop(self, inter, btn):
         gid = inter.guild.id
         loop_enabled[gid] = not loop_enabled.get(gid, False)
         btn.style = discord.ButtonStyle.success if loop_enabled[gid] else discord.ButtonStyle.secondary
-        await inter.message.edit(view=self)
-        await inter.response.defer()
+        await inter.response.edit_message(view=self)
 
     @discord.ui.button(label="Stop", style=discord.ButtonStyle.danger, row=0)
     async def stop(self, inter, btn):
         await clear_skip_requests(inter.guild)
-        await hard_stop(inter.guild)
+        get_player(inter.guild).post(CMD_STOP)
         await inter.response.defer()
 
     @discord.ui.button(label="Refresh", style=discord.ButtonStyle.primary, row=0)
     async def refresh(self, inter, btn):
         await clear_skip_requests(inter.guild)
-        await soft_refresh(inter.guild)
+        get_player(inter.guild).post(CMD_REFRESH)
         await inter.response.defer()
 
 
-# ==================================================
-# NOW PLAYING UI
-# ==================================================
-async def update_nowplaying(guild, title, thumbnail):
+guild_controls_view = {}
+
+
+def get_controls(gid):
+    # one view per now-playing message, reused for every edit
+    view = guild_controls_view.get(gid)
+    if view is None:
+        view = guild_controls_view[gid] = MusicControls(gid)
+    return view
+
+
+# ==================================================
+# NOW PLAYING UI
+# ==================================================
+async def update_nowplaying(guild):
+
+    gid = guild.id
+    current = guild_current.get(gid) or {}
+    title = current.get("title", current.get("query"))
+    thumbnail = current.get("thumbnail")
+
+    elapsed = song_elapsed(gid)
+    total = song_duration.get(gid, 1)
+
+    fmt = lambda t: f"{int(t//60)}:{int(t%60):02d}"
+    progress = build_progress(elapsed, total)
+
+    queue = get_queue(gid)
+    up_next_text = ""
+    if queue:
+        nxt = queue.peek().query
+        nxt = nxt if len(nxt) < 50 else nxt[:50] + "..."
+        up_next_text = f"\n>> **Up Next:** {nxt}"
+
+    # a mention renders from the ID alone, no member needed
+    owner = guild_current.get(gid, {}).get("owner_id")
+
+    embed = discord.Embed(
+        title="⋆｡°✩ NOW PLAYING ✩°｡⋆ 💜",
+        description=(
+            f"💜 Requested by ⋆｡° <@{owner}> °｡⋆\n\n"
+            f"💫 **{title}** 💫\n"
+            f"⏱️ `{fmt(elapsed)} / {fmt(total)}`\n\n"
+            f"`{progress}`\n"
+            f"━━━ ✦ ━━━"
+            f"{up_next_text}"
+        ),
+        color=PURPLE,
+    )
+
+    if thumbnail:
+        embed.set_image(url=thumbnail)
+
+    embed.set_footer(text="Created By ｍａｒｒｌｙ４")
+
+    view = get_controls(gid).sync(guild)
+
+    old = guild_nowplaying_msg.get(gid)
+    if old:
+        edit_scheduler.schedule(old, embed=embed, view=view)
+    else:
+        channel = guild.get_channel(guild_music_settings[gid])
+        guild_nowplaying_msg[gid] = await send_tracked(channel, embed=embed, view=view)
+
+
+# ==================================================
+# PROGRESS TICKER
+# ==================================================
+PROGRESS_TICK = 10          # seconds for one pass over the active guilds
+PROGRESS_EDIT_BUDGET = float(os.getenv("PROGRESS_EDIT_BUDGET", "4"))   # edits/sec, all guilds
+PROGRESS_BATCH = 10
+
+progress_task = None
+
+
+async def progress_ticker():
+    # One task for every guild: each pass refreshes as many playing guilds
+    # as the budget allows, round-robin, spread out over the tick.
+    cursor = 0
+    per_pass = max(1, int(PROGRESS_EDIT_BUDGET * PROGRESS_TICK))
+
+    while True:
+        active = [
+            gid for gid, player in guild_players.items()
+            if player.state == STATE_PLAYING
+            and guild_nowplaying_msg.get(gid)
+            and not song_paused_at.get(gid)
+        ]
+        if not active:
+            await asyncio.sleep(PROGRESS_TICK)
+            continue
+
+        cursor %= len(active)
+        batch = (active[cursor:] + active[:cursor])[:per_pass]
+        cursor += len(batch)
+
+        # the whole pass takes one tick, however many batches it has
+        pause = PROGRESS_TICK / math.ceil(len(batch) / PROGRESS_BATCH)
+        for i in range(0, len(batch), PROGRESS_BATCH):
+            for gid in batch[i:i + PROGRESS_BATCH]:
+                player = guild_players.get(gid)
+                if player and player.state == STATE_PLAYING:
+                    try:
+                        await update_nowplaying(player.guild)
+                    except Exception as e:
+                        print("Progress update error:", e)
+            await asyncio.sleep(pause)
+
+
+def start_progress_ticker():
+    global progress_task
+    if progress_task is None or progress_task.done():
+        progress_task = asyncio.create_task(progress_ticker())
+
+
+# ==================================================
+# FINALIZE SKIP
+# ==================================================
+async def finalize_skip(guild):
+    get_player(guild).post(CMD_SKIP)
+
+
+# ==================================================
+# TRACK RESOLUTION
+# ==================================================
+async def extract_info(url, flat=False, priority=PRIORITY_USER, gid=None):
+    return await extractor_pool.extract(url, flat=flat, priority=priority, gid=gid)
+
+
+def entry_thumbnail(entry):
+    if entry.get("thumbnail"):
+        return entry["thumbnail"]
+    # flat search entries only carry the thumbnails list
+    thumbs = entry.get("thumbnails") or []
+    return thumbs[-1].get("url") if thumbs else None
+
+
+# ==================================================
+# OPUS DISK CACHE
+# ==================================================
+OPUS_CACHE_DIR = os.getenv("OPUS_CACHE_DIR", "")   # empty = off
+OPUS_CACHE_MAX_MB = int(os.getenv("OPUS_CACHE_MAX_MB", "1024"))
+OPUS_CACHE_AFTER_PLAYS = int(os.getenv("OPUS_CACHE_AFTER_PLAYS", "3"))
+OPUS_CACHE_MAX_SECONDS = 900     # long mixes are not worth the disk
+OPUS_CACHE_FILLS = 2             # ffmpeg downloads at once
+OPUS_CACHE_BITRATE = "128k"      # only used when the source isn't opus already
+OPUS_CACHE_FORGET_AFTER = 30 * 86400   # play counts of uncached tracks
+
+
+class CachedOpusAudio(discord.AudioSource):
+    # plays an Ogg/Opus file straight from disk, packets go out as they are
+    def __init__(self, path, start=0):
+        self._file = open(path, "rb")
+        self._packets = OggStream(self._file).iter_packets()
+        for _ in range(int(start * PACKETS_PER_SECOND)):
+            if not self.read():
+                break
+
+    def read(self):
+        for packet in self._packets:
+            if not packet.startswith((b"OpusHead", b"OpusTags")):
+                return packet
+        return b""
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self._file.close()
+
+
+class OpusCache:
+    # video ID -> pre-encoded .opus file, filled in the background once a
+    # track has been played OPUS_CACHE_AFTER_PLAYS times, LRU by total size
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.fills = 0
+        self.evictions = 0
+        self._plays = 0
+        self._lock = threading.Lock()
+        self._filling = set()
+        self._sem = None
+        self._files = OrderedDict()   # {vid: {"size", "title", "thumbnail", "duration"}}
+        self._total = 0
+
+        self.enabled = bool(root) and not WORKER_IMPORT
+        if not self.enabled:
+            return
+
+        os.makedirs(root, exist_ok=True)
+        self._db = open_db()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS opus_cache ("
+            " video_id TEXT PRIMARY KEY, plays INTEGER NOT NULL DEFAULT 0,"
+            " size INTEGER NOT NULL DEFAULT 0, title TEXT, thumbnail TEXT,"
+            " duration INTEGER, accessed_at REAL NOT NULL)"
+        )
+
+        rows = self._db.execute(
+            "SELECT video_id, size, title, thumbnail, duration FROM opus_cache"
+            " WHERE size > 0 ORDER BY accessed_at"
+        ).fetchall()
+        for vid, size, title, thumbnail, duration in rows:
+            if os.path.exists(self.path(vid)):
+                self._files[vid] = {
+                    "size": size, "title": title,
+                    "thumbnail": thumbnail, "duration": duration,
+                }
+                self._total += size
+            else:
+                self._db.execute(
+                    "UPDATE opus_cache SET size = 0 WHERE video_id = ?", (vid,)
+                )
+
+    def path(self, vid):
+        return os.path.join(self.root, f"{vid}.opus")
+
+    def resolved(self, vid):
+        # everything a play needs, without touching YouTube
+        entry = self._files.get(vid) if self.enabled else None
+        if not entry:
+            return None
+
+        # another shard process may have evicted it
+        if not os.path.exists(self.path(vid)):
+            del self._files[vid]
+            self._total -= entry["size"]
+            return None
+
+        self._files.move_to_end(vid)
+        self.hits += 1
+        return {
+            "id": vid,
+            "url": None,
+            "path": self.path(vid),
+            "title": entry["title"],
+            "thumbnail": entry["thumbnail"],
+            "duration": entry["duration"],
+            "codec": "opus",
+            "bitrate": None,
+        }
+
+    def usable(self, resolved):
+        return bool(resolved.get("url")) or os.path.exists(resolved.get("path") or "")
+
+    def _count_play(self, vid):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO opus_cache (video_id, plays, accessed_at) VALUES (?, 1, ?)"
+                " ON CONFLICT(video_id) DO UPDATE SET plays = plays + 1, accessed_at = ?",
+                (vid, now, now),
+            )
+            plays = self._db.execute(
+                "SELECT plays FROM opus_cache WHERE video_id = ?", (vid,)
+            ).fetchone()[0]
+
+            self._plays += 1
+            if self._plays % 100 == 0:
+                self._db.execute(
+                    "DELETE FROM opus_cache WHERE size = 0 AND accessed_at < ?",
+                    (now - OPUS_CACHE_FORGET_AFTER,),
+                )
+        return plays
+
+    async def record_play(self, resolved):
+        if not self.enabled:
+            return
+
+        vid = resolved["id"]
+        plays = await asyncio.to_thread(self._count_play, vid)
+        if (
+            plays >= OPUS_CACHE_AFTER_PLAYS
+            and vid not in self._files
+            and vid not in self._filling
+            and resolved.get("url")
+            and resolved["duration"] <= OPUS_CACHE_MAX_SECONDS
+        ):
+            self._filling.add(vid)
+            spawn(self._fill(resolved))
+
+    async def _fill(self, resolved):
+        vid = resolved["id"]
+        final = self.path(vid)
+        part = final + ".part"
+
+        if resolved.get("codec") == "opus":
+            codec_args = ["-c:a", "copy"]
+        else:
+            codec_args = ["-c:a", "libopus", "-b:a", OPUS_CACHE_BITRATE]
+
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(OPUS_CACHE_FILLS)
+
+        try:
+            async with self._sem:
+                proc = await asyncio.create_subprocess_exec(
+                    "ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+                    *shlex.split(FFMPEG_OPTIONS["before_options"]),
+                    "-i", resolved["url"], "-vn", "-map", "0:a:0",
+                    *codec_args, "-f", "ogg", part,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                _, err = await proc.communicate()
+
+            if proc.returncode != 0:
+                print(f"Opus cache fill failed for {vid}:", err.decode(errors="ignore").strip()[-200:])
+                return
+
+            os.replace(part, final)
+            size = os.path.getsize(final)
+            await asyncio.to_thread(self._store, resolved, size)
+
+            self._files[vid] = {
+                "size": size, "title": resolved["title"],
+                "thumbnail": resolved["thumbnail"], "duration": resolved["duration"],
+            }
+            self._total += size
+            self.fills += 1
+            await self._evict()
+        except Exception as e:
+            print("Opus cache fill error:", e)
+        finally:
+            self._filling.discard(vid)
+            if os.path.exists(part):
+                os.remove(part)
+
+    def _store(self, resolved, size):
+        with self._lock:
+            self._db.execute(
+                "UPDATE opus_cache SET size = ?, title = ?, thumbnail = ?,"
+                " duration = ?, accessed_at = ? WHERE video_id = ?",
+                (size, resolved["title"], resolved["thumbnail"],
+                 resolved["duration"], time.time(), resolved["id"]),
+            )
+
+    def _drop(self, vids):
+        for vid in vids:
+            try:
+                os.remove(self.path(vid))
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._db.executemany(
+                "UPDATE opus_cache SET size = 0 WHERE video_id = ?",
+                [(vid,) for vid in vids],
+            )
+
+    async def _evict(self):
+        # least recently played first; an open file keeps playing after unlink
+        victims = []
+        while self._total > self.max_bytes and len(self._files) > 1:
+            vid, entry = self._files.popitem(last=False)
+            self._total -= entry["size"]
+            victims.append(vid)
+
+        if victims:
+            self.evictions += len(victims)
+            await asyncio.to_thread(self._drop, victims)
+
+    def stats(self):
+        return {
+            "files": len(self._files),
+            "mb": self._total / 1024 / 1024,
+            "hits": self.hits,
+            "fills": self.fills,
+            "evictions": self.evictions,
+        }
+
+
+opus_cache = OpusCache(OPUS_CACHE_DIR, OPUS_CACHE_MAX_MB * 1024 * 1024)
+
+
+# ==================================================
+# SHARED SOURCES
+# ==================================================
+SHARED_SOURCES = os.getenv("SHARED_SOURCES", "0") == "1"
+SHARED_WINDOW = int(os.getenv("SHARED_WINDOW", "120"))   # seconds a late guild can still join
+SHARED_LEAD = 5           # seconds read ahead of the furthest listener
+PACKETS_PER_SECOND = 50   # discord sends one 20 ms opus packet at a time
+
+
+class SharedStream:
+    # One ffmpeg upstream for a video, its packets kept in a ring buffer.
+    # Every listener reads from its own position. The pump stays only
+    # SHARED_LEAD ahead of the furthest listener, so the start of the track
+    # stays available for SHARED_WINDOW seconds.
+    def __init__(self, resolved):
+        self.vid = resolved["id"]
+        self.resolved = resolved
+        self.capacity = (SHARED_WINDOW + SHARED_LEAD) * PACKETS_PER_SECOND
+        self.lead = SHARED_LEAD * PACKETS_PER_SECOND
+        self.ring = [None] * self.capacity
+        self.written = 0
+        self.finished = False
+        self.closed = False
+        self.positions = {}   # {listener: next packet index}
+        self.cond = threading.Condition()
+        self.source = discord.FFmpegOpusAudio(
+            resolved["url"],
+            codec=resolved["codec"],
+            bitrate=resolved["bitrate"],
+            **FFMPEG_OPTIONS
+        )
+        threading.Thread(target=self._pump, daemon=True).start()
+
+    def joinable(self):
+        # packet 0 still in the ring → a new listener hears the whole track
+        return not self.closed and self.written <= self.capacity
+
+    def _pump(self):
+        while True:
+            with self.cond:
+                while not self.closed and (
+                    not self.positions
+                    or self.written >= max(self.positions.values()) + self.lead
+                ):
+                    self.cond.wait(0.5)
+                if self.closed:
+                    return
+
+            packet = self.source.read()
+
+            with self.cond:
+                if not packet:
+                    self.finished = True
+                    self.cond.notify_all()
+                    return
+                self.ring[self.written % self.capacity] = packet
+                self.written += 1
+                self.cond.notify_all()
+
+    def read(self, listener):
+        with self.cond:
+            while True:
+                pos = self.positions.get(listener)
+                if pos is None or self.closed:
+                    return b""
+                if pos < self.written:
+                    break
+                if self.finished:
+                    return b""
+                self.cond.wait(1)
+
+            # paused until its next packet was overwritten
+            if pos < self.written - self.capacity:
+                return None
+            self.positions[listener] = pos + 1
+            packet = self.ring[pos % self.capacity]
+            self.cond.notify_all()
+            return packet
+
+    def add(self, listener):
+        with self.cond:
+            self.positions[listener] = 0
+            self.cond.notify_all()
+
+    def remove(self, listener):
+        with self.cond:
+            if self.positions.pop(listener, None) is None:
+                return False
+            if self.positions:
+                self.cond.notify_all()
+                return False
+            self.closed = True
+            self.cond.notify_all()
+        self.source.cleanup()
+        return True
+
+
+class SharedAudio(discord.AudioSource):
+    def __init__(self, hub, stream):
+        self.hub = hub
+        self.stream = stream
+        self.own = None
+        stream.add(self)
+
+    def read(self):
+        if self.own:
+            return self.own.read()
+
+        pos = self.stream.positions.get(self)
+        packet = self.stream.read(self)
+        if packet is not None:
+            return packet
+
+        # fell behind the shared window (paused), carry on alone from here
+        r = self.stream.resolved
+        self.hub.release(self)
+        self.own = discord.FFmpegOpusAudio(
+            r["url"],
+            codec=r["codec"],
+            bitrate=r["bitrate"],
+            before_options=f"{FFMPEG_OPTIONS['before_options']} -ss {pos / PACKETS_PER_SECOND:.2f}",
+            options=FFMPEG_OPTIONS["options"],
+        )
+        return self.own.read()
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        if self.own:
+            self.own.cleanup()
+        self.hub.release(self)
+
+
+class SourceHub:
+    # video ID -> live upstreams; guilds playing the same video share one
+    # ffmpeg process and one download
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._streams = {}   # {vid: [SharedStream]}
+        self.opened = 0
+        self.shared = 0
+
+    def open(self, resolved):
+        vid = resolved["id"]
+        with self._lock:
+            streams = self._streams.setdefault(vid, [])
+            stream = next((s for s in streams if s.joinable()), None)
+            if stream:
+                self.shared += 1
+            else:
+                stream = SharedStream(resolved)
+                streams.append(stream)
+                self.opened += 1
+            return SharedAudio(self, stream)
+
+    def release(self, audio):
+        stream = audio.stream
+        if not stream.remove(audio):
+            return
+
+        with self._lock:
+            streams = self._streams.get(stream.vid, [])
+            if stream in streams:
+                streams.remove(stream)
+            if not streams:
+                self._streams.pop(stream.vid, None)
+
+    def stats(self):
+        with self._lock:
+            streams = [s for group in self._streams.values() for s in group]
+        return {
+            "upstreams": len(streams),
+            "listeners": sum(len(s.positions) for s in streams),
+            "opened": self.opened,
+            "shared": self.shared,
+        }
+
+
+source_hub = SourceHub()
+
+
+# ==================================================
+# STREAM URL CACHE
+# ==================================================
+STREAM_CACHE_MAX = int(os.getenv("STREAM_CACHE_MAX", "500"))
+STREAM_URL_MARGIN = 300          # seconds of validity to keep beyond the song length
+STREAM_URL_DEFAULT_TTL = 3600    # for URLs without an expire= field
+STREAM_EXPIRE_REGEX = re.compile(r"[?&/]expire[=/](\d+)")
+
+
+def stream_usable(r):
+    return r["expires"] - time.time() >= r["duration"] + STREAM_URL_MARGIN
+
+
+class StreamCache:
+    # video ID -> resolved stream (URL + codec info), dropped once the
+    # googlevideo URL would expire before the song could finish. With
+    # `shared` set, entries also go to disk for the other shard processes.
+    def __init__(self, max_entries, shared=None):
+        self.max_entries = max_entries
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self._items = OrderedDict()
+
+    def get(self, vid):
+        r = self._items.get(vid)
+        if r and not stream_usable(r):
+            del self._items[vid]
+            r = None
+
+        if not r:
+            self.misses += 1
+            return None
+
+        self._items.move_to_end(vid)
+        self.hits += 1
+        return dict(r)
+
+    def put(self, resolved):
+        m = STREAM_EXPIRE_REGEX.search(resolved["url"])
+        expires = int(m.group(1)) if m else time.time() + STREAM_URL_DEFAULT_TTL
+
+        self._remember(dict(resolved, expires=expires))
+
+    def _remember(self, r):
+        self._items[r["id"]] = r
+        self._items.move_to_end(r["id"])
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+    async def aget(self, vid):
+        r = self.get(vid)
+        if r or not self.shared:
+            return r
+
+        r = await self.shared.aget(vid)
+        if not r or not stream_usable(r):
+            return None
+        self.shared_hits += 1
+        self._remember(r)
+        return dict(r)
+
+    async def aput(self, resolved):
+        self.put(resolved)
+        if self.shared:
+            await self.shared.aset(resolved["id"], self._items[resolved["id"]])
+
+    def __len__(self):
+        return len(self._items)
+
+
+stream_cache = StreamCache(
+    STREAM_CACHE_MAX,
+    DiskCache("stream", 6 * 3600, STREAM_CACHE_MAX * 4) if SHARD_PROCESSES > 1 else None,
+)
+
+
+def stream_codec(entry):
+    # codec/bitrate from the format yt-dlp picked, None if it didn't say
+    acodec = entry.get("acodec")
+    if not acodec or acodec == "none":
+        return None
+
+    bitrate = int(entry.get("abr") or 128)
+    bitrate = max(16, min(512, bitrate))
+
+    # passthrough only works for 48 kHz opus, anything else gets encoded
+    if acodec == "opus":
+        return ("opus" if entry.get("asr") in (None, 48000) else None), bitrate
+    return acodec, bitrate
+
+
+async def build_resolved(entry, query, meta=None):
+    meta = meta or entry
+
+    # ffprobe only when yt-dlp didn't report the codec
+    codec_info = stream_codec(entry)
+    if codec_info:
+        codec, bitrate = codec_info
+    else:
+        codec, bitrate = await discord.FFmpegOpusAudio.probe(entry["url"])
+
+    resolved = {
+        "id": entry["id"],
+        "url": entry["url"],
+        "title": meta.get("title") or entry.get("title") or query,
+        "thumbnail": entry_thumbnail(meta) or entry_thumbnail(entry),
+        "duration": meta.get("duration") or entry.get("duration") or 120,
+        "codec": codec,
+        "bitrate": bitrate,
+    }
+    await stream_cache.aput(resolved)
+    return resolved
+
+
+async def resolve_video(vid, query, meta=None, priority=PRIORITY_USER, gid=None):
+    resolved = opus_cache.resolved(vid) or await stream_cache.aget(vid)
+    if resolved:
+        return resolved
+
+    info = await extract_info(
+        f"https://www.youtube.com/watch?v={vid}", priority=priority, gid=gid
+    )
+    if not info or not info.get("url"):
+        return None
+    return await build_resolved(info, query, meta=meta)
+
+
+async def resolve_track(gid, query, video_id=None, priority=PRIORITY_USER):
+    # loop/replay: the exact video is already known
+    if video_id:
+        return await resolve_video(video_id, query, priority=priority, gid=gid)
+
+    played = get_history(gid)
+
+    if query.startswith("http"):
+        info = await extract_info(query, priority=priority, gid=gid)
+        if not info:
+            return None
+        if "entries" not in info:
+            if info.get("id") in played:
+                return None
+            return await build_resolved(info, query)
+
+        # playlist / set links: the first entry we haven't played yet
+        for e in info["entries"] or []:
+            if not e or not e.get("id") or e["id"] in played:
+                continue
+            if e.get("url"):
+                return await build_resolved(e, query)
+            resolved = await resolve_video(e["id"], query, meta=e, priority=priority, gid=gid)
+            if resolved:
+                return resolved
+        return None
+
+    # ✅ known query → only the stream URL needs fetching
+    key = normalize_query(query)
+    hit = await search_cache.aget(key)
+    remember = not hit
+    if hit and hit["id"] not in played:
+        resolved = await resolve_video(
+            hit["id"], query, meta=hit, priority=priority, gid=gid
+        )
+        if resolved:
+            return resolved
+        remember = True   # cached video is gone, replace it
+
+    # phase 1: flat search, IDs and titles only
+    info = await extract_info(
+        f"ytsearch5:{query}", flat=True, priority=priority, gid=gid
+    )
+    if not info:
+        return None
+
+    for e in info.get("entries") or []:
+        if not e:
+            continue
+
+        vid = e.get("id")
+        if not vid or vid in played:
+            continue
+
+        # phase 2: full format extraction for the chosen video only
+        resolved = await resolve_video(
+            vid, query, meta=e, priority=priority, gid=gid
+        )
+        if not resolved:
+            continue
+
+        if remember:
+            await search_cache.aset(key, {
+                "id": vid,
+                "title": resolved["title"],
+                "duration": resolved["duration"],
+                "thumbnail": resolved["thumbnail"],
+            })
+
+        return resolved
+
+    return None
+
+
+def seek_options(start):
+    if not start:
+        return FFMPEG_OPTIONS
+    return dict(
+        FFMPEG_OPTIONS,
+        before_options=f"{FFMPEG_OPTIONS['before_options']} -ss {start:.2f}",
+    )
+
+
+def make_source(resolved, start=0):
+    if resolved.get("path"):
+        return CachedOpusAudio(resolved["path"], start)
+
+    # a shared upstream always starts at 0
+    if SHARED_SOURCES and not start:
+        return source_hub.open(resolved)
+
+    return discord.FFmpegOpusAudio(
+        resolved["url"],
+        codec=resolved["codec"],
+        bitrate=resolved["bitrate"],
+        **seek_options(start)
+    )
+
+
+# ==================================================
+# GAPLESS PLAYBACK
+# ==================================================
+GAPLESS = os.getenv("GAPLESS", "1") == "1"
+GAPLESS_LEAD = 8   # seconds before the end the next decoder gets spawned
+# >0 mixes PCM instead of passing opus through, costs an encode per guild
+GAPLESS_CROSSFADE = float(os.getenv("GAPLESS_CROSSFADE", "0"))
+PCM_FRAME_SIZE = 3840   # 20 ms of 48 kHz stereo s16
+
+
+def make_pcm_source(resolved, start=0):
+    if resolved.get("path"):
+        before = f"-ss {start:.2f}" if start else None
+        return discord.FFmpegPCMAudio(resolved["path"], before_options=before, options="-vn")
+    return discord.FFmpegPCMAudio(resolved["url"], **seek_options(start))
+
+
+def mix_pcm(a, b, t):
+    # fade a out and b in, t goes 0 → 1 over the crossfade
+    x = array("h", a.ljust(PCM_FRAME_SIZE, b"\0"))
+    y = array("h", b.ljust(PCM_FRAME_SIZE, b"\0"))
+    return array("h", (
+        max(-32768, min(32767, int(p * (1 - t) + q * t)))
+        for p, q in zip(x, y)
+    )).tobytes()
+
+
+class GaplessSource(discord.AudioSource):
+    # The voice client keeps playing this one source for as long as tracks
+    # follow each other. The next track's decoder is armed a few seconds
+    # before the end and takes over on the very next packet (or fades in).
+    def __init__(self, source, duration, on_switch):
+        self.current = source
+        self.on_switch = on_switch   # called from the audio thread
+        self.pcm = GAPLESS_CROSSFADE > 0
+        self.fade_frames = int(GAPLESS_CROSSFADE * PACKETS_PER_SECOND)
+        self.frames = 0
+        self.total_frames = duration * PACKETS_PER_SECOND
+        self._next = None     # (source, duration, still_valid)
+        self._fading = None   # (outgoing source, frames done)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make(resolved, start=0):
+        if GAPLESS_CROSSFADE > 0:
+            return make_pcm_source(resolved, start)
+        return make_source(resolved, start)
+
+    def arm(self, source, duration, still_valid):
+        with self._lock:
+            old, self._next = self._next, (source, duration, still_valid)
+        if old:
+            old[0].cleanup()
+
+    def disarm(self):
+        with self._lock:
+            old, self._next = self._next, None
+        if old:
+            old[0].cleanup()
+
+    def _switch(self):
+        with self._lock:
+            nxt, self._next = self._next, None
+        if not nxt:
+            return None
+
+        source, duration, still_valid = nxt
+        if not still_valid():
+            source.cleanup()
+            return None
+
+        outgoing = self.current
+        self.current = source
+        self.frames = 0
+        self.total_frames = duration * PACKETS_PER_SECOND
+        self.on_switch()
+        return outgoing
+
+    def read(self):
+        if self._fading:
+            return self._read_fade()
+
+        # start the crossfade while the outgoing track still has audio
+        if (
+            self.fade_frames
+            and self._next
+            and self.frames >= self.total_frames - self.fade_frames
+        ):
+            outgoing = self._switch()
+            if outgoing:
+                self._fading = (outgoing, 0)
+                return self._read_fade()
+
+        packet = self.current.read()
+        if packet:
+            self.frames += 1
+            return packet
+
+        outgoing = self._switch()
+        if not outgoing:
+            return b""
+        outgoing.cleanup()
+        self.frames += 1
+        return self.current.read()
+
+    def _read_fade(self):
+        outgoing, done = self._fading
+        a = outgoing.read()
+        b = self.current.read()
+        self.frames += 1
+
+        done += 1
+        if not a or done >= self.fade_frames:
+            outgoing.cleanup()
+            self._fading = None
+            return b
+        self._fading = (outgoing, done)
+        return mix_pcm(a, b, done / self.fade_frames)
+
+    def is_opus(self):
+        return not self.pcm
+
+    def cleanup(self):
+        self.disarm()
+        if self._fading:
+            self._fading[0].cleanup()
+            self._fading = None
+        self.current.cleanup()
+
+
+# ==================================================
+# PREFETCH
+# ==================================================
+guild_prefetch = {}   # {gid: {"item": Track, "task": Task}}
+
+
+async def prefetch_resolve(gid, item, priority=PRIORITY_PREFETCH):
+    try:
+        resolved = await resolve_track(
+            gid, item.query, item.video_id, priority=priority
+        )
+    except Exception as e:
+        print("Prefetch error:", e)
+        return None
+
+    queue = get_queue(gid)
+    if resolved and queue.peek() is item and item.duration != resolved["duration"]:
+        queue.set_duration(item, resolved["duration"])
+    return resolved
+
+
+def cancel_prefetch(gid):
+    pf = guild_prefetch.pop(gid, None)
+    if pf:
+        pf["task"].cancel()
+
+
+def start_prefetch(guild):
+    gid = guild.id
+    queue = get_queue(gid)
+    pf = guild_prefetch.get(gid)
+
+    if queue:
+        head = queue.peek()
+        if pf and pf["item"] is head:
+            return
+
+        cancel_prefetch(gid)
+        guild_prefetch[gid] = {
+            "item": head,
+            "task": asyncio.create_task(prefetch_resolve(gid, head)),
+        }
+
+    else:
+        cancel_prefetch(gid)
+
+    if smart_play_enabled.get(gid):
+        get_smart_pool(gid).refill()
+
+
+async def take_prefetch(gid, item):
+    # only the exact queue item the prefetch was started for counts,
+    # anything else means the queue moved on and the result is stale
+    pf = guild_prefetch.get(gid)
+    if not pf or pf["item"] is not item:
+        return None
+
+    guild_prefetch.pop(gid, None)
+    try:
+        resolved = await pf["task"]
+    except (Exception, asyncio.CancelledError):
+        return None
+
+    if (
+        resolved
+        and not item.video_id
+        and resolved["id"] in get_history(gid)
+    ):
+        return None
+    return resolved
+
+
+# ==================================================
+# SMART PLAY POOL
+# ==================================================
+SMART_POOL_SIZE = int(os.getenv("SMART_POOL_SIZE", "5"))
+SMART_POOL_LOW = 2
+SMART_POOL_MAX_TRIES = SMART_POOL_SIZE * 3   # per refill round
+
+guild_smart_pools = {}
+
+
+class SmartPool:
+    # Recommendation candidates already resolved to a playable video, kept
+    # topped up in the background so autoplay starts like a queued song.
+    # Failures here are silent and never count toward MAX_SMART_TRIES.
+    def __init__(self, gid):
+        self.gid = gid
+        self.candidates = deque()   # (Track, seed artist)
+        self._task = None
+
+    def _usable(self, track, seed):
+        return (
+            seed in get_seeds(self.gid)
+            and track.video_id not in get_history(self.gid)
+        )
+
+    def take(self):
+        while self.candidates:
+            track, seed = self.candidates.popleft()
+            if self._usable(track, seed):
+                self.refill()
+                return track
+        self.refill()
+        return None
+
+    def refill(self):
+        if len(self.candidates) >= SMART_POOL_LOW:
+            return
+        if self._task and not self._task.done():
+            return
+        if smart_play_enabled.get(self.gid) and get_seeds(self.gid):
+            self._task = spawn(self._fill())
+
+    async def _fill(self):
+        gid = self.gid
+        for _ in range(SMART_POOL_MAX_TRIES):
+            if len(self.candidates) >= SMART_POOL_SIZE or not smart_play_enabled.get(gid):
+                return
+
+            seeds = list(get_seeds(gid))
+            if not seeds:
+                return
+
+            seed = random.choice(seeds)
+            pool = await spotify_artist_pool(seed)
+            if not pool:
+                continue
+
+            title, duration, _ = random.choice(pool)
+            taken = {t.video_id for t, _ in self.candidates}
+
+            try:
+                resolved = await resolve_track(gid, title, priority=PRIORITY_SMART)
+            except Exception as e:
+                print("Smart pool error:", e)
+                continue
+
+            if not resolved or resolved["id"] in taken:
+                continue
+
+            track = Track(title, bot.user.id, resolved["id"], resolved["duration"])
+            if self._usable(track, seed):
+                self.candidates.append((track, seed))
 
-    gid = guild.id
+    def clear(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self.candidates.clear()
 
-    elapsed = time.time() - song_start_time.get(gid, 0)
-    total = song_duration.get(gid, 1)
 
-    fmt = lambda t: f"{int(t//60)}:{int(t%60):02d}"
-    progress = build_progress(elapsed, total)
+def get_smart_pool(gid):
+    pool = guild_smart_pools.get(gid)
+    if pool is None:
+        pool = guild_smart_pools[gid] = SmartPool(gid)
+    return pool
 
-    queue = guild_queues.get(gid, [])
-    up_next_text = ""
-    if queue:
-        nxt = queue[0]["query"]
-        nxt = nxt if len(nxt) < 50 else nxt[:50] + "..."
-        up_next_text = f"\n>> **Up Next:** {nxt}"
 
-    owner = guild_current.get(gid, {}).get("owner_id")
-    owner_member = guild.get_member(owner)
+def clear_smart_pool(gid):
+    pool = guild_smart_pools.pop(gid, None)
+    if pool:
+        pool.clear()
 
-    embed = discord.Embed(
-        title="⋆｡°✩ NOW PLAYING ✩°｡⋆ 💜",
-        description=(
-            f"💜 Requested by ⋆｡° {owner_member.mention} °｡⋆\n\n"
-            f"💫 **{title}** 💫\n"
-            f"⏱️ `{fmt(elapsed)} / {fmt(total)}`\n\n"
-            f"`{progress}`\n"
-            f"━━━ ✦ ━━━"
-            f"{up_next_text}"
-        ),
-        color=PURPLE,
-    )
 
-    if thumbnail:
-        embed.set_image(url=thumbnail)
+# ==================================================
+# GUILD PLAYER
+# ==================================================
+CMD_ENQUEUE = "enqueue"
+CMD_SKIP = "skip"
+CMD_STOP = "stop"
+CMD_REFRESH = "refresh"
+CMD_TRACK_ENDED = "track_ended"
+CMD_HANDOFF = "handoff"   # gapless source moved on to the armed track
+CMD_RESTORE = "restore"   # first command of every player, loads the saved state
+
+STATE_IDLE = "idle"
+STATE_RESOLVING = "resolving"
+STATE_PLAYING = "playing"
+
+MAX_PLAY_ATTEMPTS = 25   # dead tracks in a row before the player gives up
+
+guild_players = {}
+
+
+class GuildPlayer:
+    # One long-lived task per guild. Everything that changes playback goes
+    # through its command queue, so skip/stop/track-end can't race each other.
+    def __init__(self, guild):
+        self.guild = guild
+        self.gid = guild.id
+        self.state = STATE_IDLE
+        self.voice_channel = None
+        self.current = None          # (item, resolved) of the playing track
+        self.play_token = 0          # bumped whenever we stop playback ourselves
+        self.source = None           # GaplessSource while gapless is on
+        self.armed = None            # (item, resolved) waiting in the source
+        self.resume = None           # (item, offset) of a restored track
+        self._advancing = None
+        self._commands = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    def post(self, cmd, data=None):
+        # stop/refresh/skip must not wait behind a slow resolution, but once
+        # the track is playing they wait for its messages like anything else
+        if (cmd in (CMD_STOP, CMD_REFRESH, CMD_SKIP) and self._advancing
+                and self.state == STATE_RESOLVING):
+            self._advancing.cancel()
+        if cmd in (CMD_STOP, CMD_REFRESH):
+            cancel_expansions(self.gid)   # no more pages after the stop
+        self._commands.put_nowait((cmd, data or {}))
+
+    async def _run(self):
+        while True:
+            cmd, data = await self._commands.get()
+            try:
+                await self._handle(cmd, data)
+            except Exception as e:
+                print(f"Player error ({self.gid}):", e)
 
-    embed.set_footer(text="Created By ｍａｒｒｌｙ４")
+    async def _handle(self, cmd, data):
+        gid = self.gid
 
-    channel = guild.get_channel(guild_music_settings[gid])
+        if cmd == CMD_ENQUEUE:
+            if data.get("voice_channel"):
+                self.voice_channel = data["voice_channel"]
 
-    view = MusicControls(gid)
+            items = data["items"]
+            added = get_queue(gid).extend(items)
+            if added < len(items):
+                ch = self.guild.get_channel(guild_music_settings[gid])
+                if ch:
+                    await ch.send(
+                        f"⚠️ Queue limit reached ({MAX_TRACKS_PER_USER} songs per user) 💜",
+                        delete_after=5
+                    )
 
-    old = guild_nowplaying_msg.get(gid)
-    if old:
-        await old.edit(embed=embed, view=view)
-    else:
-        guild_nowplaying_msg[gid] = await channel.send(embed=embed, view=view)
+            if self.state == STATE_IDLE:
+                await self._advance()
+            else:
+                start_prefetch(self.guild)
+                await update_queue_display(self.guild)
 
+        elif cmd == CMD_TRACK_ENDED:
+            if data["token"] != self.play_token:
+                return   # we stopped that track on purpose
 
-# ==================================================
-# FINALIZE SKIP
-# ==================================================
-async def finalize_skip(guild):
-    vc = guild.voice_client
-    if vc and vc.is_playing():
-        vc.stop()
+            if data.get("error"):
+                print("Playback error:", data["error"])
 
+            await clear_skip_requests(self.guild)
 
-# ==================================================
-# PLAY MUSIC
-# ==================================================
-async def play_music(guild, msg=None):
-    gid = guild.id
-    smart_fail_count.setdefault(gid, 0)
-    
-    if not first_run_cleanup.get(gid):
-        first_run_cleanup[gid] = True
+            if self.current:
+                item, resolved = self.current
+                if loop_enabled.get(gid) and item.owner_id != bot.user.id:
+                    get_queue(gid).push_front(
+                        Track(item.query, item.owner_id, resolved["id"], resolved["duration"])
+                    )
 
-        ch = guild.get_channel(guild_music_settings[gid])
-        async for m in ch.history(limit=200):
-            if m.author.bot:
-                try:
-                    await m.delete()
-                except:
-                    pass
+            await self._advance()
 
-        guild_nowplaying_msg[gid] = None
-        guild_queue_msg[gid] = None
+        elif cmd == CMD_RESTORE:
+            await self._restore()
 
-    queue = guild_queues.get(gid, [])
+        elif cmd == CMD_HANDOFF:
+            if data["token"] != self.play_token or not self.armed:
+                return
 
-    if not queue:
-        guild_current[gid] = None
+            await clear_skip_requests(self.guild)
 
-        if smart_play_enabled.get(gid):
-            spotify_query = spotify_smart_pick(gid)
-            if spotify_query:
-                guild_queues.setdefault(gid, []).append({
-                    "query": spotify_query,
-                    "owner_id": bot.user.id
-                })
-                return await play_music(guild, msg)
+            item, resolved = self.armed
+            self.armed = None
+            queue = get_queue(gid)
+            if queue.peek() is item:
+                queue.pop()
 
-        return
+            guild_current[gid] = {"query": item.query, "owner_id": item.owner_id}
+            await self._begin(item, resolved)
 
+        elif cmd == CMD_SKIP:
+            vc = self.guild.voice_client
+            playing = vc and (vc.is_playing() or vc.is_paused())
+            if self.state == STATE_IDLE and not get_queue(gid) and not playing:
+                return
+            self._stop_voice()
+            await clear_skip_requests(self.guild)
+            await self._advance()
+
+        elif cmd == CMD_STOP:
+            self._set_idle()
+            self.play_token += 1
+            await hard_stop(self.guild)
+
+        elif cmd == CMD_REFRESH:
+            self._set_idle()
+            self.play_token += 1
+            await soft_refresh(self.guild)
+
+    def _stop_voice(self):
+        self.play_token += 1
+        vc = self.guild.voice_client
+        if vc and (vc.is_playing() or vc.is_paused()):
+            vc.stop()
+
+    def _set_idle(self):
+        self.state = STATE_IDLE
+        self.current = None
+        guild_current[self.gid] = None
+
+    async def _advance(self):
+        self.state = STATE_RESOLVING
+        self._advancing = asyncio.create_task(self._play_next())
+        await asyncio.wait([self._advancing])
+
+        task, self._advancing = self._advancing, None
+        if task.cancelled():
+            if self.state == STATE_RESOLVING:
+                self._set_idle()
+        elif task.exception():
+            print(f"Player error ({self.gid}):", task.exception())
+            self._set_idle()
+
+    async def _play_next(self):
+        gid = self.gid
+        guild = self.guild
+        smart_fail_count.setdefault(gid, 0)
+
+        if not first_run_cleanup.get(gid):
+            first_run_cleanup[gid] = True
+
+            # whatever the last run left behind, in the background
+            purge_channel_later(guild)
+
+            edit_scheduler.forget(guild_nowplaying_msg.get(gid))
+            edit_scheduler.forget(guild_queue_msg.get(gid))
+            guild_nowplaying_msg[gid] = None
+            guild_queue_msg[gid] = None
+            guild_controls_view.pop(gid, None)
+
+        for _ in range(MAX_PLAY_ATTEMPTS):
+            item = await self._next_item()
+            if not item:
+                self._set_idle()
+                return
 
+            guild_current[gid] = {"query": item.query, "owner_id": item.owner_id}
+            await clear_skip_requests(guild)
 
+            vc = await self._ensure_voice()
+            if not vc:
+                self._set_idle()
+                return
 
+            resolved = await self._resolve(item)
+            if resolved and not opus_cache.usable(resolved):
+                # cached file was evicted while this track waited in prefetch
+                resolved = await resolve_video(
+                    resolved["id"], item.query, meta=resolved, gid=gid
+                )
+            if not resolved:
+                # جرّب أغنية ثانية (من الكويي/سمارت)
+                continue
 
+            await self._start(vc, item, resolved)
+            return
 
-    item = queue.pop(0)
-    owner = item["owner_id"]
-    query = item["query"]
+        print(f"❌ Player gave up after {MAX_PLAY_ATTEMPTS} failed tracks")
+        self._set_idle()
 
-    guild_current[gid] = {"query": query, "owner_id": owner}
-    await clear_skip_requests(guild)
+    async def _next_item(self):
+        gid = self.gid
+        queue = get_queue(gid)
+        if queue:
+            return queue.pop()
 
-    vc = guild.voice_client
+        if not smart_play_enabled.get(gid):
+            return None
 
-    # 🛑 أوقف الصوت فقط إذا vc موجود
-    if vc and (vc.is_playing() or vc.is_paused()):
-        vc.stop()
+        # a candidate resolved in the background while the last song played
+        track = get_smart_pool(gid).take()
+        if track:
+            return track
 
+        spotify_query = await spotify_smart_pick(gid)
+        if spotify_query:
+            return Track(spotify_query, bot.user.id)
+        return None
 
+    async def _ensure_voice(self):
+        vc = self.guild.voice_client
 
+        # 🛑 أوقف الصوت فقط إذا vc موجود
+        if vc:
+            self._stop_voice()
+            return vc
 
-    if not vc:
-        if not msg or not msg.author.voice:
-            return
+        if not self.voice_channel:
+            return None
 
         try:
-            vc = await msg.author.voice.channel.connect(timeout=10)
+            return await self.voice_channel.connect(timeout=10)
         except asyncio.TimeoutError:
             print("❌ Voice connection timeout")
-            return
+            return None
 
+    async def _resolve(self, item):
+        gid = self.gid
+        owner = item.owner_id
 
-    yt_query = f"ytsearch5:{query}" if not query.startswith("http") else query
-    loop = asyncio.get_running_loop()
-    try:
-        info = await loop.run_in_executor(
-            None,
-            functools.partial(ytdl.extract_info, yt_query, download=False)
-        )
-    except Exception as e:
-        print("YTDL error:", e)
+        resolved = await take_prefetch(gid, item)
+        if resolved:
+            return resolved
+
+        try:
+            return await resolve_track(
+                gid, item.query, item.video_id,
+                priority=PRIORITY_SMART if owner == bot.user.id else PRIORITY_USER,
+            )
+        except Exception as e:
+            print("YTDL error:", e)
 
         # إذا هذه أغنية سمارت بلي (owner_id مالها bot.user.id) نعدّها فشل
         if owner == bot.user.id:
@@ -541,71 +3187,307 @@ async def play_music(guild, msg=None):
                 smart_play_enabled[gid] = False
                 smart_fail_count.pop(gid, None)
 
-
-                ch = guild.get_channel(guild_music_settings[gid])
+                ch = self.guild.get_channel(guild_music_settings[gid])
                 if ch:
                     await ch.send("⚠️ Smart Play stopped بسبب فشل متكرر من YouTube. شغّل أغنية جديدة يدويًا 💜", delete_after=8)
 
-                guild_current[gid] = None
+        return None
+
+    async def _start(self, vc, item, resolved):
+        self.play_token += 1
+        token = self.play_token
+
+        start = 0
+        if self.resume and self.resume[0] is item:
+            start = self.resume[1]
+        self.resume = None
+
+        if GAPLESS:
+            source = GaplessSource(
+                GaplessSource.make(resolved, start), resolved["duration"],
+                lambda: bot.loop.call_soon_threadsafe(
+                    self.post, CMD_HANDOFF, {"token": token}
+                ),
+            )
+        else:
+            source = make_source(resolved, start)
+        self.source = source
+        self.armed = None
+
+        # token belongs to this vc.play, gapless handoffs keep it
+        vc.play(
+            source,
+            after=lambda e: bot.loop.call_soon_threadsafe(
+                self.post, CMD_TRACK_ENDED, {"token": token, "error": e}
+            ),
+        )
+        await self._begin(item, resolved, start)
+
+    async def _begin(self, item, resolved, start=0):
+        gid = self.gid
+
+        get_history(gid).add(resolved["id"])
+        spawn(opus_cache.record_play(resolved))
+
+        # ✅ نجحنا نجيب فيديو صالح
+        smart_fail_count.pop(gid, None)
+
+        reset_song_clock(gid, resolved["duration"], start)
+        guild_current[gid]["title"] = resolved["title"]
+        guild_current[gid]["thumbnail"] = resolved["thumbnail"]
+
+        self.current = (item, resolved)
+        self.state = STATE_PLAYING
+
+        start_prefetch(self.guild)
+        if GAPLESS:
+            spawn(self._arm_next(self.play_token, resolved["id"]))
+
+        await update_nowplaying(self.guild)
+        await update_queue_display(self.guild)
+
+    async def _restore(self):
+        gid = self.gid
+        snap = await player_state.take(gid)
+        if not snap:
+            return
+
+        loop_enabled[gid] = snap["loop"]
+        smart_play_enabled[gid] = snap["smart"]
+
+        items = [Track(*t) for t in snap["queue"]]
+        cur = snap.get("current")
+        if cur:
+            track = Track(*cur["track"])
+            items.insert(0, track)
+            self.resume = (track, cur["offset"])
+        get_queue(gid).extend(items)
+
+        if snap["voice_channel"]:
+            self.voice_channel = self.guild.get_channel(snap["voice_channel"])
+        print(f"♻️ Restored {len(items)} tracks for guild {gid}")
+
+        # only pick up where we were if someone is still listening
+        listening = self.voice_channel and any(
+            not m.bot for m in self.voice_channel.members
+        )
+        if cur and not cur["paused"] and listening:
+            await reattach_messages(self.guild, snap)
+            await self._advance()
+
+    async def _arm_next(self, token, vid):
+        gid = self.gid
+
+        def playing_this():
+            cur = self.current
+            return token == self.play_token and cur and cur[1]["id"] == vid
+
+        # wait (pause aware) until the track is nearly over
+        while playing_this():
+            remaining = song_duration.get(gid, 0) - song_elapsed(gid)
+            if remaining <= GAPLESS_LEAD:
+                break
+            await asyncio.sleep(min(remaining - GAPLESS_LEAD, 5))
+
+        # loop replays the current song, smart picks wait for the normal path
+        queue = get_queue(gid)
+        item = queue.peek()
+        if not playing_this() or not item or loop_enabled.get(gid):
+            return
+
+        resolved = await take_prefetch(gid, item)
+        if not resolved:
+            try:
+                resolved = await resolve_track(
+                    gid, item.query, item.video_id, priority=PRIORITY_PREFETCH
+                )
+            except Exception as e:
+                print("Gapless resolve error:", e)
                 return
 
-        # جرّب أغنية ثانية (من الكويي/سمارت)
-        return await play_music(guild, msg)
+        if not resolved or not playing_this() or queue.peek() is not item:
+            return
+        if not opus_cache.usable(resolved):
+            return
 
+        source = self.source
+        source.arm(
+            await asyncio.to_thread(GaplessSource.make, resolved),
+            resolved["duration"],
+            lambda: queue.peek() is item and not loop_enabled.get(gid),
+        )
+        self.armed = (item, resolved)
 
-    entries = info["entries"] if "entries" in info else [info]
 
-    played_video_ids.setdefault(gid, set())
+def get_player(guild):
+    player = guild_players.get(guild.id)
+    if not player:
+        player = guild_players[guild.id] = GuildPlayer(guild)
+        if guild.id in player_state.pending:
+            player.post(CMD_RESTORE)
+    return player
 
-    info = None
-    for e in entries:
-        if not e:
-            continue
 
-        vid = e.get("id")
-        if not vid:
-            continue
+# ==================================================
+# PLAYER STATE (RESTARTS)
+# ==================================================
+STATE_FLUSH_EVERY = 30
+STATE_MAX_AGE = 6 * 3600   # older snapshots are not worth resuming
 
-        if vid in played_video_ids[gid]:
-            continue
 
-        info = e
-        played_video_ids[gid].add(vid)
-        break
+class PlayerStateStore:
+    # one JSON snapshot per guild: queue, current track + offset, flags and
+    # the message IDs to reattach to. Rows are only rewritten when changed.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._db = open_db()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS player_state ("
+            " guild_id INTEGER PRIMARY KEY, voice_channel_id INTEGER,"
+            " state TEXT NOT NULL, saved_at REAL NOT NULL)"
+        )
+        if not WORKER_IMPORT:
+            self._db.execute(
+                "DELETE FROM player_state WHERE saved_at < ?",
+                (time.time() - STATE_MAX_AGE,),
+            )
+        # {gid: voice channel id} saved last run, restored on first activity
+        self.pending = dict(self._db.execute(
+            "SELECT guild_id, voice_channel_id FROM player_state"
+        ).fetchall())
+        self._saved = {}   # {gid: last written JSON}
+
+    def _load(self, gid):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state FROM player_state WHERE guild_id = ?", (gid,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def take(self, gid):
+        self.pending.pop(gid, None)
+        self._saved[gid] = ""   # the old row gets replaced or deleted on the next flush
+        return await asyncio.to_thread(self._load, gid)
+
+    def _write(self, rows, gone):
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO player_state VALUES (?, ?, ?, ?)",
+                [(gid, vc_id, state, now) for gid, vc_id, state in rows],
+            )
+            self._db.executemany(
+                "DELETE FROM player_state WHERE guild_id = ?", [(g,) for g in gone]
+            )
+
+    async def save(self, snapshots):
+        # snapshots: {gid: dict or None}
+        rows, gone = [], []
+        for gid, snap in snapshots.items():
+            state = json.dumps(snap) if snap else None
+            if state == self._saved.get(gid):
+                continue
+            self._saved[gid] = state
+            if state:
+                rows.append((gid, snap["voice_channel"], state))
+            else:
+                gone.append(gid)
+
+        if rows or gone:
+            await asyncio.to_thread(self._write, rows, gone)
 
 
-    if not info:
-        return await play_music(guild, msg)
+player_state = PlayerStateStore()
 
 
-    # ✅ نجحنا نجيب فيديو صالح
-    smart_fail_count.pop(gid, None)
+def snapshot_player(player):
+    gid = player.gid
+    vc = player.guild.voice_client
+    queue = [[t.query, t.owner_id, t.video_id, t.duration] for t in get_queue(gid)]
 
+    current = None
+    if player.current and player.state == STATE_PLAYING:
+        item, resolved = player.current
+        current = {
+            "track": [item.query, item.owner_id, resolved["id"], resolved["duration"]],
+            "offset": round(song_elapsed(gid), 1),
+            "paused": bool(vc and vc.is_paused()),
+        }
+
+    if not queue and not current:
+        return None
+
+    channel = vc.channel if vc else player.voice_channel
+    np = guild_nowplaying_msg.get(gid)
+    qm = guild_queue_msg.get(gid)
+    return {
+        "queue": queue,
+        "current": current,
+        "voice_channel": channel.id if channel else None,
+        "loop": bool(loop_enabled.get(gid)),
+        "smart": bool(smart_play_enabled.get(gid)),
+        "nowplaying_msg": np.id if np else None,
+        "queue_msg": qm.id if qm else None,
+    }
+
+
+async def flush_player_state():
+    await player_state.save({
+        gid: snapshot_player(player) for gid, player in list(guild_players.items())
+    })
 
 
-    url = info["url"]
-    title = info.get("title", query)
-    thumb = info.get("thumbnail")
-    dur = info.get("duration", 120)
+state_task = None
 
-    song_start_time[gid] = time.time()
-    song_duration[gid] = dur
 
-    src = await discord.FFmpegOpusAudio.from_probe(url, **FFMPEG_OPTIONS)
+async def state_flush_loop():
+    while True:
+        await asyncio.sleep(STATE_FLUSH_EVERY)
+        try:
+            await flush_player_state()
+        except Exception as e:
+            print("State flush error:", e)
 
-    async def after_play(_):
-        await clear_skip_requests(guild)
 
-        if loop_enabled.get(gid) and owner != bot.user.id:
-            guild_queues[gid].insert(0, {"query": query, "owner_id": owner})
+async def shutdown():
+    print("🛑 Shutting down, saving state")
+    for flush in (flush_player_state, flush_history):
+        try:
+            await flush()
+        except Exception as e:
+            print("Flush error on shutdown:", e)
+    try:
+        await sp.close()
+    except Exception as e:
+        print("Spotify close error:", e)
+    await bot.close()
+
 
+async def reattach_messages(guild, snap):
+    # keep the old now playing / queue messages instead of reposting them
+    gid = guild.id
+    ch = guild.get_channel(guild_music_settings.get(gid))
+    if not ch:
+        return
 
-        await play_music(guild, msg)
+    keep = []
+    for key, store in (("nowplaying_msg", guild_nowplaying_msg), ("queue_msg", guild_queue_msg)):
+        if not snap.get(key):
+            continue
+        try:
+            store[gid] = await ch.fetch_message(snap[key])
+            keep.append(snap[key])
+        except discord.HTTPException:
+            store[gid] = None
 
-    vc.play(src, after=lambda e: asyncio.run_coroutine_threadsafe(after_play(e), bot.loop))
+    # the old ◀/▶ buttons belong to a view that died with the last run;
+    # this rides along with the first queue edit (the now playing message
+    # gets its view on every edit anyway)
+    if guild_queue_msg.get(gid):
+        edit_scheduler.schedule(guild_queue_msg[gid], view=QueueControls(gid))
 
-    await update_nowplaying(guild, title, thumb)
-    await update_queue_display(guild)
+    first_run_cleanup[gid] = True
+    spawn(purge_bot_messages(ch, keep=keep))
 
 
 # ==================================================
@@ -614,7 +3496,10 @@ async def play_music(guild, msg=None):
 async def hard_stop(guild):
     gid = guild.id
     smart_fail_count.pop(gid, None)
-
+    cancel_prefetch(gid)
+    cancel_expansions(gid)
+    clear_smart_pool(gid)
+    extractor_pool.cancel_guild(gid)
 
 
     # 1️⃣ إيقاف الصوت
@@ -623,23 +3508,22 @@ async def hard_stop(guild):
         await vc.disconnect(force=True)
 
     # 2️⃣ حذف كل رسائل البوت من القناة
-    ch = guild.get_channel(guild_music_settings[gid])
-    async for m in ch.history(limit=200):
-        try:
-            await m.delete()
-        except:
-            pass
+    purge_channel_later(guild)
 
     # 3️⃣ تصفير كل الحالات
-    guild_queues[gid] = []
+    get_queue(gid).clear()
     guild_current[gid] = None
     skip_pending[gid] = None
     smart_play_enabled[gid] = False
-    smart_play_seed[gid] = set()
-    played_video_ids[gid] = set()
+    get_seeds(gid).clear()
+    get_history(gid).clear()
 
+    edit_scheduler.forget(guild_nowplaying_msg.get(gid))
+    edit_scheduler.forget(guild_queue_msg.get(gid))
     guild_nowplaying_msg[gid] = None
     guild_queue_msg[gid] = None
+    guild_queue_pager.pop(gid, None)
+    guild_controls_view.pop(gid, None)
 
     # 4️⃣ نرجع البوت كأنه جديد
     first_run_cleanup[gid] = False
@@ -652,29 +3536,30 @@ async def hard_stop(guild):
 # ==================================================
 async def soft_refresh(guild):
     gid = guild.id
+    cancel_prefetch(gid)
+    cancel_expansions(gid)
+    clear_smart_pool(gid)
+    extractor_pool.cancel_guild(gid)
 
     vc = guild.voice_client
     if vc and (vc.is_playing() or vc.is_paused()):
         vc.stop()  # ⬅️ هذا السطر المهم
 
-    ch = guild.get_channel(guild_music_settings[gid])
-    if ch:
-        async for m in ch.history(limit=200):
-            if m.author.bot:
-                try:
-                    await m.delete()
-                except:
-                    pass
+    purge_channel_later(guild)
 
+    edit_scheduler.forget(guild_nowplaying_msg.get(gid))
+    edit_scheduler.forget(guild_queue_msg.get(gid))
     guild_nowplaying_msg[gid] = None
     guild_queue_msg[gid] = None
+    guild_queue_pager.pop(gid, None)
+    guild_controls_view.pop(gid, None)
     guild_current[gid] = None
-    guild_queues[gid] = []
+    get_queue(gid).clear()
     skip_pending[gid] = None
 
     smart_play_enabled[gid] = False
-    smart_play_seed[gid] = set()
-    played_video_ids[gid] = set()
+    get_seeds(gid).clear()
+    get_history(gid).clear()
     smart_fail_count.pop(gid, None)
 
 
@@ -685,67 +3570,68 @@ async def soft_refresh(guild):
 # ==================================================
 
 
-def spotify_to_title(text):
-    try:
-        match = SPOTIFY_TRACK_REGEX.search(text)
-        if not match:
-            return None
-
-        track_id = match.group(1)
-        track = sp.track(track_id)
-
-        song = track["name"]
-        artist = track["artists"][0]["name"]
+async def spotify_artist_id(artist_name):
+    key = normalize_query(artist_name)
+    artist_id = await spotify_artist_cache.get(key)
+    if artist_id is not None:
+        return artist_id or None
 
-        return f"{artist} - {song}"
-    except Exception as e:
-        print("Spotify error:", e)
-        return None
+    result = await sp.search(q=f"artist:{artist_name}", type="artist", limit=1)
+    items = result["artists"]["items"]
+    artist_id = items[0]["id"] if items else ""
+    await spotify_artist_cache.set(key, artist_id)
+    return artist_id or None
 
-def spotify_smart_pick(gid):
-    seeds = list(smart_play_seed.get(gid, []))
-    if not seeds:
-        return None
 
-    artist_name = random.choice(seeds)
+async def spotify_artist_pool(artist_name):
+    key = normalize_query(artist_name)
+    pool = await spotify_pool_cache.get(key)
+    if pool is not None:
+        return pool
 
+    pool = []
     try:
         # 1️⃣ نحاول recommendations أولاً
-        result = sp.search(q=f"artist:{artist_name}", type="artist", limit=1)
-        if not result["artists"]["items"]:
+        artist_id = await spotify_artist_id(artist_name)
+        if not artist_id:
             raise Exception("Artist not found on Spotify")
 
-        artist_id = result["artists"]["items"][0]["id"]
-
-        recs = sp.recommendations(
+        recs = await sp.recommendations(
             seed_artists=[artist_id],
             limit=20,
             min_popularity=30
         )
-
-        tracks = recs.get("tracks", [])
-        if tracks:
-            track = random.choice(tracks)
-            return f"{track['artists'][0]['name']} - {track['name']}"
-
-        raise Exception("Empty recommendations")
+        pool = list(filter(None, map(spotify_entry, recs.get("tracks", []))))
+        if not pool:
+            raise Exception("Empty recommendations")
 
     except Exception as e:
         print("Spotify Smart fallback:", e)
 
         # 2️⃣ 🔄 Fallback: search أغاني للفنان
         try:
-            res = sp.search(q=artist_name, type="track", limit=20)
-            items = res["tracks"]["items"]
-            if not items:
-                return None
-
-            track = random.choice(items)
-            return f"{track['artists'][0]['name']} - {track['name']}"
-
+            res = await sp.search(q=artist_name, type="track", limit=20)
+            pool = list(filter(None, map(spotify_entry, res["tracks"]["items"])))
         except Exception as e:
             print("Spotify fallback failed:", e)
-            return None
+            return []
+
+    pool = [list(e) for e in pool]
+    await spotify_pool_cache.set(key, pool, None if pool else SPOTIFY_EMPTY_TTL)
+    return pool
+
+
+async def spotify_smart_pick(gid):
+    seeds = list(get_seeds(gid))
+    if not seeds:
+        return None
+
+    artist_name = random.choice(seeds)
+    pool = await spotify_artist_pool(artist_name)
+    if not pool:
+        return None
+
+    return random.choice(pool)[0]
 
 
 async def safe_delete(msg):
@@ -762,11 +3648,175 @@ def feed_smart_seed(gid, query):
     artist = extract_artist(query)
     if not artist:
         return
-    smart_play_seed.setdefault(gid, set()).add(artist)
+    get_seeds(gid).add(artist)
+
+
+
+
+
+def enqueue(msg, items):
+    if not items:
+        return
+    voice = msg.author.voice
+    get_player(msg.guild).post(CMD_ENQUEUE, {
+        "items": items,
+        "voice_channel": voice.channel if voice else None,
+    })
+
+
+guild_expansions = {}   # {gid: set(Task)} Spotify links still being expanded
+
+
+def cancel_expansions(gid):
+    for task in guild_expansions.pop(gid, ()):
+        task.cancel()
+
+
+async def expand_links(msg, links):
+    gid = msg.guild.id
+    owner = msg.author.id
+    queued = 0
+    # pages are applied later by the player, so count what we posted ourselves
+    room = MAX_TRACKS_PER_USER - get_queue(gid).user_count(owner)
+
+    def add(items):
+        nonlocal queued
+        take = items[:max(room - queued, 0)]
+        enqueue(msg, take)
+        queued += len(take)
+        return len(take) == len(items)
+
+    def add_spotify(entries):
+        for _, _, artist in entries[:max(room - queued, 0)]:
+            get_seeds(gid).add(artist)
+        return add([Track(title, owner, duration=duration) for title, duration, _ in entries])
+
+    async def limit_reached():
+        await msg.channel.send(
+            f"⚠️ Queue limit reached ({MAX_TRACKS_PER_USER} songs per user) 💜",
+            delete_after=5
+        )
+
+    # consecutive track links share one batched lookup, order is kept
+    track_ids = []
+    try:
+        for kind, cid in links:
+            if kind == "track":
+                track_ids.append(cid)
+                continue
+
+            if track_ids:
+                if not add_spotify(await spotify_tracks_by_id(track_ids)):
+                    return await limit_reached()
+                track_ids = []
+
+            if kind == INPUT_YOUTUBE:
+                if not add([Track(f"https://youtu.be/{cid}", owner, video_id=cid)]):
+                    return await limit_reached()
+                continue
+            if kind == INPUT_URL:
+                if not add([Track(cid, owner)]):
+                    return await limit_reached()
+                continue
+
+            async for entries in iter_spotify_collection(kind, cid):
+                if not add_spotify(entries):
+                    return await limit_reached()
+
+        if track_ids:
+            if not add_spotify(await spotify_tracks_by_id(track_ids)):
+                return await limit_reached()
+
+    except Exception as e:
+        print("Spotify error:", e)
+        if not queued:
+            await msg.channel.send(
+                "⚠️ Spotify is slow right now, try again 💚",
+                delete_after=5
+            )
+
+
+def start_expansion(msg, links):
+    task = spawn(expand_links(msg, links))
+    tasks = guild_expansions.setdefault(msg.guild.id, set())
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+
+
+# ==================================================
+# INPUT CLASSIFIER
+# ==================================================
+INPUT_TEXT = "text"
+INPUT_YOUTUBE = "youtube"
+INPUT_URL = "url"
+INPUT_LINKS = "links"     # Spotify links and/or several URLs, expanded in the background
+
+YOUTUBE_ID_REGEX = re.compile(
+    r"(?:youtu\.be/|youtube\.com/(?:watch\?(?:\S*&)?v=|shorts/|embed/|live/))([\w-]{11})"
+)
+LINK_HINTS = ("://", "spotify.com/", "youtu")
+
+
+def classify_input(raw):
+    # one pass over the message, no network: -> (kind, payload)
+    if not any(h in raw for h in LINK_HINTS):
+        return INPUT_TEXT, raw
+
+    links = []
+    for word in raw.split():
+        m = SPOTIFY_LINK_REGEX.search(word)
+        if m:
+            links.append(m.groups())
+            continue
+        m = YOUTUBE_ID_REGEX.search(word)
+        if m:
+            links.append((INPUT_YOUTUBE, m.group(1)))
+        elif word.startswith(("http://", "https://")):
+            links.append((INPUT_URL, word))
+
+    if not links:
+        return INPUT_TEXT, raw
+    if len(links) == 1 and links[0][0] in (INPUT_YOUTUBE, INPUT_URL):
+        return links[0]
+    return INPUT_LINKS, links
 
 
+def ack(msg, text):
+    # tell the user right away, resolving happens after. The text carries
+    # what the user typed, so it must never ping anyone
+    spawn(msg.channel.send(
+        text, delete_after=5, allowed_mentions=discord.AllowedMentions.none()
+    ))
 
 
+async def handle_text(msg, query):
+    feed_smart_seed(msg.guild.id, query)
+    enqueue(msg, [Track(query, msg.author.id)])
+    ack(msg, f"🔎 **{query}** added 💜")
+
+
+async def handle_youtube(msg, vid):
+    enqueue(msg, [Track(f"https://youtu.be/{vid}", msg.author.id, video_id=vid)])
+    ack(msg, "🎶 Video added 💜")
+
+
+async def handle_url(msg, url):
+    enqueue(msg, [Track(url, msg.author.id)])
+    ack(msg, "🎶 Link added 💜")
+
+
+async def handle_links(msg, links):
+    start_expansion(msg, links)
+    ack(msg, f"📥 Loading {len(links)} link{'s' if len(links) > 1 else ''}… 💜")
+
+
+INPUT_HANDLERS = {
+    INPUT_TEXT: handle_text,
+    INPUT_YOUTUBE: handle_youtube,
+    INPUT_URL: handle_url,
+    INPUT_LINKS: handle_links,
+}
+
 
 @bot.event
 async def on_message(msg):
@@ -790,66 +3840,68 @@ async def on_message(msg):
 
 
 
-    # ===== Spotify PLAYLIST =====
-    playlist_tracks, playlist_artists = spotify_playlist_to_tracks(raw)
-    if playlist_tracks:
-        await safe_delete(msg)
+    if not raw:
+        return
 
-        smart_play_seed.setdefault(gid, set()).update(playlist_artists)
+    kind, payload = classify_input(raw)
+    await INPUT_HANDLERS[kind](msg, payload)
+    await safe_delete(msg)
 
-        first = playlist_tracks[0]
-        guild_queues.setdefault(gid, []).append({
-            "query": first,
-            "owner_id": msg.author.id
-        })
-        feed_smart_seed(gid, first)
 
-        for song in playlist_tracks[1:]:
-            guild_queues[gid].append({
-                "query": song,
-                "owner_id": msg.author.id
-            })
-            feed_smart_seed(gid, song)
 
-        if not guild_current.get(gid):
-            await play_music(msg.guild, msg)
-        else:
-            await update_queue_display(msg.guild)
 
-        return
 
-    # ===== Spotify TRACK =====
-    spotify_title = spotify_to_title(raw)
 
-    if "open.spotify.com/track" in raw and not spotify_title:
-        await safe_delete(msg)
-        await msg.channel.send(
-            "⚠️ Spotify is slow right now, try again 💚",
-            delete_after=5
-        )
-        return
+# ==================================================
+# QUEUE COMMANDS
+# ==================================================
+async def queue_changed(ctx, note):
+    await safe_delete(ctx.message)
+    await ctx.send(note, delete_after=5)
 
-    query = spotify_title if spotify_title else raw
+    if guild_current.get(ctx.guild.id):
+        start_prefetch(ctx.guild)
+    await update_queue_display(ctx.guild)
 
-    guild_queues.setdefault(gid, []).append({
-        "query": query,
-        "owner_id": msg.author.id
-    })
-    feed_smart_seed(gid, query)
 
-    await safe_delete(msg)
+@bot.command()
+async def shuffle(ctx):
+    if ctx.guild.id not in guild_music_settings:
+        return
+    get_queue(ctx.guild.id).shuffle()
+    await queue_changed(ctx, "🔀 Queue shuffled 💜")
 
-    if not guild_current.get(gid):
-        await play_music(msg.guild, msg)
-    else:
-        await update_queue_display(msg.guild)
 
-    await bot.process_commands(msg)
-    return
+@bot.command()
+async def dedupe(ctx):
+    if ctx.guild.id not in guild_music_settings:
+        return
+    removed = get_queue(ctx.guild.id).dedupe()
+    await queue_changed(ctx, f"🧹 Removed {removed} duplicate songs 💜")
+
+
+@bot.command()
+async def remove(ctx, position: int):
+    if ctx.guild.id not in guild_music_settings:
+        return
+    queue = get_queue(ctx.guild.id)
+    if not 1 <= position <= len(queue):
+        return await ctx.send("⚠️ No song at that position", delete_after=5)
 
+    track = queue.remove(position - 1)
+    await queue_changed(ctx, f"🗑️ Removed **{track.query}** 💜")
 
 
+@bot.command()
+async def move(ctx, src: int, dst: int):
+    if ctx.guild.id not in guild_music_settings:
+        return
+    queue = get_queue(ctx.guild.id)
+    if not (1 <= src <= len(queue) and 1 <= dst <= len(queue)):
+        return await ctx.send("⚠️ No song at that position", delete_after=5)
 
+    queue.move(src - 1, dst - 1)
+    await queue_changed(ctx, f"↕️ Moved song {src} → {dst} 💜")
 
 
 # ==================================================
@@ -869,10 +3921,7 @@ async def setup(ctx):
     class Pick(discord.ui.Select):
         async def callback(self, inter):
             cid = int(self.values[0])
-            guild_music_settings[ctx.guild.id] = cid
-
-            settings["guild_music_settings"] = guild_music_settings
-            save_settings(settings)
+            await settings_store.set(ctx.guild.id, "music_channel", cid)
 
             await inter.response.send_message("Music channel saved ✓", ephemeral=True)
 
@@ -882,17 +3931,174 @@ async def setup(ctx):
     await ctx.send("🎶 Choose the music channel:", view=view)
 
 
+# ==================================================
+# STATS COMMAND (OWNER ONLY)
+# ==================================================
+@bot.command()
+async def stats(ctx):
+    if ctx.author.id != OWNER_ID:
+        return
+
+    s = await asyncio.to_thread(search_cache.stats)
+    embed = discord.Embed(title="📊 Bot Stats", color=PURPLE)
+    embed.add_field(
+        name="Search cache",
+        value=(
+            f"hits `{s['hits']}` · misses `{s['misses']}` · "
+            f"hit rate `{s['hit_rate']:.0%}` · entries `{s['size']}`"
+        ),
+        inline=False,
+    )
+    x = extractor_pool.stats()
+    embed.add_field(
+        name="Extractor pool",
+        value=(
+            f"queued `{x['queued']}` · running `{x['running']}` · "
+            f"done `{x['completed']}` · failed `{x['failed']}` · "
+            f"timeouts `{x['timeouts']}` · cancelled `{x['cancelled']}`"
+        ),
+        inline=False,
+    )
+    e = edit_scheduler.stats()
+    embed.add_field(
+        name="Message edits",
+        value=(
+            f"requested `{e['requested']}` · sent `{e['sent']}` · "
+            f"coalesced `{e['coalesced']}` · 429s `{e['rate_limited']}` · "
+            f"pending `{e['pending']}`"
+        ),
+        inline=False,
+    )
+    embed.add_field(
+        name="Spotify caches",
+        value="\n".join(
+            f"{name}: hit rate `{c['hit_rate']:.0%}` · "
+            f"mem `{c['mem_hits']}` · disk `{c['disk_hits']}` · "
+            f"misses `{c['misses']}`"
+            for name, c in ((n, cache.stats()) for n, cache in SPOTIFY_CACHES.items())
+        ),
+        inline=False,
+    )
+    embed.add_field(
+        name="Stream URL cache",
+        value=(
+            f"hits `{stream_cache.hits}` · shared `{stream_cache.shared_hits}` · "
+            f"misses `{stream_cache.misses}` · "
+            f"entries `{len(stream_cache)}`"
+        ),
+        inline=False,
+    )
+    if SHARD_COUNT:
+        embed.add_field(
+            name="Shards",
+            value=(
+                f"this process `{bot.shard_ids}` of `{SHARD_COUNT}` · "
+                f"guilds here `{len(bot.guilds)}`"
+            ),
+            inline=False,
+        )
+    if SHARED_SOURCES:
+        h = source_hub.stats()
+        embed.add_field(
+            name="Shared sources",
+            value=(
+                f"upstreams `{h['upstreams']}` · listeners `{h['listeners']}` · "
+                f"opened `{h['opened']}` · joined `{h['shared']}`"
+            ),
+            inline=False,
+        )
+    if opus_cache.enabled:
+        o = opus_cache.stats()
+        embed.add_field(
+            name="Opus disk cache",
+            value=(
+                f"files `{o['files']}` · size `{o['mb']:.0f} MB` · "
+                f"hits `{o['hits']}` · fills `{o['fills']}` · "
+                f"evictions `{o['evictions']}`"
+            ),
+            inline=False,
+        )
+    await ctx.send(embed=embed)
+
+
 # ==================================================
 # READY EVENT
 # ==================================================
 @bot.event
 async def on_ready():
     print(f"🔥 Logged in as {bot.user}")
+    start_progress_ticker()
+
+    global history_task, state_task
+    if history_task is None:
+        history_task = asyncio.create_task(history_flush_loop())
+    if state_task is None:
+        state_task = asyncio.create_task(state_flush_loop())
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, lambda: spawn(shutdown())
+            )
+        except NotImplementedError:   # windows
+            pass
+
+
+@bot.event
+async def on_voice_state_update(member, before, after):
+    # someone came back to where we were playing before the restart
+    guild = member.guild
+    if (
+        not member.bot
+        and after.channel
+        and player_state.pending.get(guild.id) == after.channel.id
+    ):
+        get_player(guild)
 
 
 # ==================================================
 # RUN BOT
 # ==================================================
-import os
-bot.run(os.getenv("DISCORD_TOKEN"))
+def run_shard_supervisor():
+    # One child process per group of shards, each a full bot for its own
+    # guilds. Caches are shared through the SQLite file; dead children
+    # are started again.
+    groups = [list(range(i, SHARD_COUNT, SHARD_PROCESSES)) for i in range(SHARD_PROCESSES)]
+    groups = [g for g in groups if g]
+    children = {}
+    stopping = False
+
+    def start(i):
+        env = dict(os.environ, SHARD_IDS=",".join(map(str, groups[i])))
+        children[i] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        print(f"🧩 Shards {groups[i]} → pid {children[i].pid}")
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        for p in children.values():
+            if p.poll() is None:
+                p.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for i in range(len(groups)):
+        start(i)
+        time.sleep(SHARD_IDENTIFY_DELAY * len(groups[i]))
+
+    while not stopping:
+        time.sleep(5)
+        for i, p in list(children.items()):
+            if not stopping and p.poll() is not None:
+                print(f"⚠️ Shard process {p.pid} exited ({p.returncode}), restarting")
+                start(i)
+
+    for p in children.values():
+        p.wait()
+
+
+if __name__ == "__main__":
+    if SHARD_COUNT and SHARD_PROCESSES > 1 and not SHARD_IDS:
+        run_shard_supervisor()
+    else:
+        bot.run(os.getenv("DISCORD_TOKEN"))
 